@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Micro benchmarks for the hot paths of pyddhcpd.
+
+Run all benchmarks with ./benchmark.py or pick some by name, e.g.
+./benchmark.py block_from_ip
+"""
+
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+from ipaddress import IPv4Address, IPv4Network
+
+from config import config
+from ddhcp import DDHCP, BlockState
+
+
+def make_config(prefix, **kwargs):
+    c = dict(config)
+    c["prefix"] = IPv4Network(prefix)
+    c.update(kwargs)
+    return c
+
+
+def bench_block_from_ip():
+    """Cost of an address to block lookup for growing pools."""
+    print("%-8s %10s %14s" % ("prefix", "blocks", "usec/lookup"))
+
+    for prefixlen in range(27, 11, -1):
+        c = make_config("10.0.0.0/%i" % prefixlen)
+        ddhcp = DDHCP(c)
+
+        first = int(c["prefix"].network_address)
+        addrs = [first + random.randrange(c["prefix"].num_addresses) for i in range(1000)]
+
+        def lookup():
+            for addr in addrs:
+                ddhcp.block_from_ip(addr)
+
+        t = min(timeit.repeat(lookup, number=10, repeat=3)) / (10 * len(addrs))
+
+        print("/%-7i %10i %14.3f" % (prefixlen, len(ddhcp.blocks), t * 1e6))
+
+
+def bench_expiry():
+    """Housekeeping expiry with 100k leases, 1% of them due."""
+    c = make_config("10.0.0.0/12", leasetime=3600, blocked=[])
+    ddhcp = DDHCP(c)
+
+    nleases = 100000
+    blocks = ddhcp.blocks[0:nleases // c["blocksize"]]
+
+    now = 1000000
+
+    for block in blocks:
+        block.state = BlockState.OURS
+        block.valid_until = now + 3600
+    for i in range(nleases):
+        block = blocks[i // c["blocksize"]]
+        addr = block.network + i % c["blocksize"]
+        # Spread lease deadlines over the next hour
+        block.get_lease(now - 2 * 3600 + (i * 3600 // nleases), addr, b"%i" % i, ddhcp.routers, ddhcp.prepare_lease)
+
+    due = now + 36
+
+    def full_scan():
+        # What housekeeping used to do on every run
+        for block in ddhcp.blocks:
+            block.reset_if_due(due)
+
+        for block in ddhcp.our_blocks():
+            for lease in block.leases.values():
+                lease.isValid(due)
+
+        timeouts = [b.valid_until for b in ddhcp.blocks]
+        timeouts += [l.valid_until for b in ddhcp.our_blocks() for l in b.leases.values()]
+        min(filter(lambda t: t > due, timeouts))
+
+    t = timeit.timeit(full_scan, number=1)
+    print("full scan:   %8.2f ms" % (t * 1e3))
+
+    t = timeit.timeit(lambda: ddhcp.expire(due), number=1)
+    print("expire:      %8.2f ms (%i leases left)" % (t * 1e3, sum(map(len, ddhcp.clients.values()))))
+
+    t = timeit.timeit(lambda: ddhcp.expiry.next_deadline(), number=1)
+    print("next timer:  %8.2f ms" % (t * 1e3))
+
+
+def bench_frames():
+    """Unicast reply frames per second, old helpers against FrameBuilder."""
+    from dhcpprotocol import FrameBuilder, mkEthernetPacket, mkIPv4Packet, mkUDPPacket
+
+    class Sock:
+        def send(self, data):
+            self.frame = bytes(data)
+
+        def sendmsg(self, buffers):
+            self.frame = b"".join(buffers)
+
+    sock = Sock()
+    servermac = bytes(6)
+    clientmac = bytes([2, 0, 0, 0, 0, 1])
+    siaddr = config["siaddr"]
+    yiaddr = IPv4Address("10.0.0.23")
+    payload = bytes(300)
+    frames = FrameBuilder(servermac, siaddr)
+
+    def helpers():
+        udpPacket = mkUDPPacket(68, 67, payload)
+        ipPacket = mkIPv4Packet(yiaddr, siaddr, 17, udpPacket)
+        sock.send(mkEthernetPacket(clientmac, servermac, 0x0800, ipPacket))
+
+    def template():
+        frames.send(sock, clientmac, yiaddr, payload)
+
+    helpers()
+    expected = sock.frame
+    template()
+    assert sock.frame == expected
+
+    n = 100000
+    for name, f in (("helpers", helpers), ("template", template)):
+        t = min(timeit.repeat(f, number=n, repeat=3))
+        print("%-10s %10.0f replies/s" % (name, n / t))
+
+
+def bench_addresses():
+    """Per-packet CPU of a peer RenewLease and memory per lease."""
+    import messages
+    from protocol import DDHCPProtocol
+
+    class Transport:
+        def sendto(self, data, addr):
+            pass
+
+    c = make_config("10.0.0.0/16", blocked=[])
+    ddhcp = DDHCP(c)
+    protocol = DDHCPProtocol(None, None, ddhcp, c)
+    protocol.transport = Transport()
+
+    block = ddhcp.blocks[5]
+    block.state = BlockState.OURS
+    lease = block.get_lease(1000000, None, b"client", ddhcp.routers, ddhcp.prepare_lease)
+
+    peer = DDHCP(c)
+    peer_protocol = DDHCPProtocol(None, None, peer, c)
+    header = peer_protocol.prepare_header()
+    header.append(messages.RenewLease(lease.addr, b"client"))
+    data = header.serialize()
+
+    def packet():
+        msg = messages.message_read(io.BytesIO(data))
+        for payload in msg.payload:
+            ddhcp.handle_RenewLease(payload, msg.node, ("::1", 1234))
+
+    n = 20000
+    t = min(timeit.repeat(packet, number=n, repeat=3)) / n
+    print("RenewLease:  %8.2f usec/packet" % (t * 1e6))
+
+    blocks = ddhcp.blocks[100:100 + 10000 // c["blocksize"]]
+    for block in blocks:
+        block.state = BlockState.OURS
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for i, block in enumerate(blocks):
+        for j in range(c["blocksize"]):
+            block.get_lease(1000000, None, b"%i" % (i * c["blocksize"] + j), ddhcp.routers, ddhcp.prepare_lease)
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("Lease:       %8.0f bytes/lease" % ((after - before) / (len(blocks) * c["blocksize"])))
+
+
+def bench_claims():
+    """UpdateClaim traffic per simulated minute in full and delta mode.
+
+       One node with 200 claimed blocks and one lease change per second.
+       Time runs 100 times faster than real time."""
+    scale = 100
+
+    class Protocol:
+        def msgsto_group(self, msgs):
+            self.datagrams += (len(msgs) + 254) // 255
+            self.payloads += len(msgs)
+
+    for mode in ("full", "delta"):
+        c = make_config("10.0.0.0/20", blocked=[], claimmode=mode,
+                        claiminterval=3 / scale, claimrefresh=20 / scale, blocktimeout=30 / scale)
+
+        loop = asyncio.new_event_loop()
+        ddhcp = DDHCP(c)
+        ddhcp.loop = loop
+        ddhcp.protocol = Protocol()
+        ddhcp.protocol.datagrams = ddhcp.protocol.payloads = 0
+
+        blocks = ddhcp.blocks[0:200]
+        for block in blocks:
+            block.state = BlockState.OURS
+            block.valid_until = 1e12
+
+        def churn(i):
+            block = blocks[i % len(blocks)]
+            block.get_lease(0, None, b"%i" % i, ddhcp.routers, ddhcp.prepare_lease)
+            loop.call_later(1 / scale, churn, i + 1)
+
+        loop.call_soon(churn, 0)
+        task = loop.create_task(ddhcp.update_claims_task())
+        loop.run_until_complete(asyncio.sleep(60 / scale))
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        loop.close()
+
+        print("%-6s %6i datagrams/min %8i claims/min" % (mode, ddhcp.protocol.datagrams, ddhcp.protocol.payloads))
+
+
+def bench_journal():
+    """Warm restart from a journal holding 100k leases."""
+    import tempfile
+    from journal import Journal
+
+    c = make_config("10.0.0.0/12", leasetime=3600, blocked=[])
+    ddhcp = DDHCP(c)
+
+    nleases = 100000
+    now = time.time()
+    blocks = ddhcp.blocks[0:nleases // c["blocksize"]]
+
+    for block in blocks:
+        block.state = BlockState.OURS
+
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = Journal(os.path.join(tmp, "journal"), c, syncinterval=0)
+        journal.start()
+        ddhcp.journal = journal
+
+        for block in blocks:
+            journal.claim(block.index)
+
+        for i in range(nleases):
+            ddhcp.blocks[i // c["blocksize"]].get_lease(now, None, b"%i" % i, ddhcp.routers, ddhcp.prepare_lease)
+
+        journal.stop()
+
+        print("journal:  %8.1f MB" % (os.path.getsize(journal.path) / 1e6))
+
+        restored = DDHCP(c)
+
+        t = time.time()
+        state = journal.load()
+        print("load:     %8.1f ms" % ((time.time() - t) * 1e3))
+
+        t = time.time()
+        restored.restore(state)
+        print("restore:  %8.1f ms (%i leases)" % ((time.time() - t) * 1e3, sum(map(len, restored.clients.values()))))
+
+
+def rss():
+    """Resident set size in bytes, None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def bench_table():
+    """Startup time and memory of the block table for growing pools."""
+    print("%-8s %10s %10s %10s %12s" % ("prefix", "blocks", "startup s", "RSS MB", "bytes/block"))
+
+    for prefixlen in (20, 18, 16, 14, 12, 10):
+        c = make_config("10.0.0.0/%i" % prefixlen, blocked=[], blocksize=4)
+
+        before = rss()
+        t = time.perf_counter()
+        ddhcp = DDHCP(c)
+        t = time.perf_counter() - t
+        after = rss()
+
+        del ddhcp
+
+        tracemalloc.start()
+        ddhcp = DDHCP(c)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        growth = "%10.1f" % ((after - before) / 1e6) if before is not None else "%10s" % "-"
+        print("/%-7i %10i %10.3f %s %12.1f" % (prefixlen, len(ddhcp.blocks), t, growth, allocated / len(ddhcp.blocks)))
+
+        del ddhcp
+
+
+benchmarks = {
+    "block_from_ip": bench_block_from_ip,
+    "expiry": bench_expiry,
+    "frames": bench_frames,
+    "addresses": bench_addresses,
+    "claims": bench_claims,
+    "journal": bench_journal,
+    "table": bench_table,
+}
+
+
+def main(names):
+    for name in names or benchmarks.keys():
+        print("== %s" % name)
+        benchmarks[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -22,6 +22,19 @@ config = {
     # Try to keep at least this many IPs ready
     "spares": 4,
 
+    # How many IPs to keep ready:
+    #   "fixed"    - spares
+    #   "adaptive" - sparefactor times the new leases expected while claiming
+    #                a block, at least spares. Blocks are freed once there
+    #                are sparehysteresis times as many IPs ready
+    "sparemode": "fixed",
+    "sparefactor": 2,
+    "sparehysteresis": 2,
+
+    # Half-life of the new lease rate estimate (seconds). Bursts are picked
+    # up with a tenth of it
+    "demandhalflife": 60,
+
     # A list of blocks that should not be used (may be [])
     "blocked": list(range(0, 2)),
 
@@ -31,9 +44,75 @@ config = {
     # For how long blocks aren't touch when another nodes sends an inquiry (seconds)
     "tentativetimeout": 15,
 
-    # Broadcast all claims every n seconds
+    # How claims are announced:
+    #   "full"  - broadcast all claims every claiminterval seconds
+    #   "delta" - broadcast new and freed claims immediately and all claims
+    #             every claimrefresh seconds, usage changes with the next
+    #             slice of that refresh
+    "claimmode": "full",
+
+    # Broadcast all claims every n seconds ("full" mode)
     "claiminterval": 3,
 
+    # Refresh all claims every n seconds, spread over claimslices slices
+    # ("delta" mode). Peers forget a claim after blocktimeout, so keep this
+    # well below it.
+    "claimrefresh": 20,
+    "claimslices": 4,
+
+    # Journal of our claims and leases, restored on startup (None disables it)
+    "journal": None,
+
+    # Write the journal to disk at most every n seconds
+    "journalsync": 1,
+
+    # Compact the journal into a snapshot every n seconds
+    "snapshotinterval": 600,
+
+    # Read up to this many datagrams per socket wakeup and handle them in one
+    # pass (0 disables batching)
+    "rxbatch": 0,
+
+    # Number of worker processes that parse and answer DHCP requests. Clients
+    # are assigned to workers by hardware address, leases are still handled
+    # by the main process (0 handles DHCP in the main process)
+    "workers": 0,
+
+    # Serve metrics in Prometheus text format over HTTP on this (host, port)
+    # tuple or Unix socket path (None disables the endpoint)
+    "metrics": None,
+
+    # Directory for profiling reports. When set, SIGUSR1 starts and stops a
+    # cProfile capture and SIGUSR2 starts and stops allocation tracing
+    # (None disables both)
+    "profiledir": None,
+
+    # Logging. "sync" writes records on the event loop, "queue" hands them
+    # to a writer thread through a queue of at most logqueue records
+    "logmode": "sync",
+    "loglevel": "DEBUG",
+    "logqueue": 10000,
+
+    # Rate limits as (records per second, burst) and sampling (keep every
+    # n-th record) by event name ("dhcp.discover") or prefix ("dhcp"), e.g.
+    # {"dhcp": (100, 200)}. Nothing is limited by default.
+    "lograte": {},
+    "logsample": {},
+
+    # Lease requests forwarded to the same peer within this many seconds
+    # are sent in one datagram
+    "peerbatch": 0.002,
+
+    # Cache up to this many leases confirmed by peers, so renewals of
+    # addresses in their blocks are answered without waiting for them (0
+    # disables the cache). A cached lease is used for peerleasewindow times
+    # its leasetime after confirmation, at most 0.5
+    "peerleasecache": 1024,
+    "peerleasewindow": 0.25,
+
+    # Verify internal indexes after every housekeeping run (slow, for testing)
+    "selfcheck": False,
+
 
     ### Config for clients
 
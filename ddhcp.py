@@ -1,14 +1,22 @@
 import asyncio
+import gc
 import random
 import time
 import logging
 
-from math import log, ceil, floor
+from array import array
+from math import ceil, floor
 from enum import Enum
-from ipaddress import IPv4Network
+from types import MappingProxyType
+from ipaddress import IPv4Address
 
 import messages
+import metrics
+from demand import DemandEstimator
+from eventlog import EventLogger, Hex, Address
+from expiry import ExpiryHeap
 from lease import Lease
+from leasecache import PeerLeaseCache
 
 # BlockStates
 #   FREE      - may be claimed after inquiry
@@ -20,34 +28,190 @@ from lease import Lease
 BlockState = Enum("BlockState", "FREE TENTATIVE CLAIMED OURS BLOCKED")
 
 
+log = EventLogger(logging.getLogger(__name__))
+
+
+PEER_LEASES = metrics.counter("ddhcp_peer_leases_total", "Lease requests forwarded to peers by outcome", ("outcome",))
+PEER_LEASE_ACK = PEER_LEASES.labels("ack")
+PEER_LEASE_NAK = PEER_LEASES.labels("nak")
+PEER_LEASE_TIMEOUT = PEER_LEASES.labels("timeout")
+PEER_LEASE_CACHE = metrics.counter("ddhcp_peer_lease_cache_total", "Lookups of leases in blocks of peers by result", ("result",))
+PEER_LEASE_CACHE_HIT = PEER_LEASE_CACHE.labels("hit")
+PEER_LEASE_CACHE_MISS = PEER_LEASE_CACHE.labels("miss")
+PEER_LEASE_SECONDS = metrics.histogram("ddhcp_peer_lease_seconds", "Round trip time of lease requests answered by peers").labels()
+
+CLAIMS = metrics.counter("ddhcp_claims_total", "Block claims by outcome", ("outcome",))
+CLAIM_SUCCESS = CLAIMS.labels("success")
+CLAIM_FAILURE = CLAIMS.labels("failure")
+CLAIM_SECONDS = metrics.histogram("ddhcp_claim_seconds", "Duration of block claims").labels()
+
+HOUSEKEEPING_SECONDS = metrics.histogram("ddhcp_housekeeping_seconds", "Duration of housekeeping runs").labels()
+
+
+# State by BlockState value, index 0 is unused
+STATES = (None,) + tuple(BlockState)
+
+# Lease storage of blocks without leases
+NO_LEASES = MappingProxyType({})
+
+
 class Block:
-    def __init__(self, subnet):
-        self.subnet = subnet
-        self.index = 0
-        self.reset()
+    """View of one block of a BlockTable, size addresses starting at
+       network. Views are created on demand and compare equal by index.
+       Addresses are ints."""
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __eq__(self, other):
+        return type(other) is Block and self.index == other.index and self.table is other.table
+
+    def __hash__(self):
+        return self.index
+
+    @property
+    def network(self):
+        return self.table.prefix_address + (self.index << self.table.block_bits)
+
+    @property
+    def size(self):
+        return self.table.blocksize
+
+    @property
+    def listener(self):
+        return self.table.listener
+
+    @property
+    def state(self):
+        return STATES[self.table.state[self.index]]
+
+    @state.setter
+    def state(self, state):
+        self.transition(state, self.addr)
+
+    @property
+    def addr(self):
+        return self.table.peers[self.table.owner[self.index]]
+
+    @property
+    def valid_until(self):
+        return self.table.valid_until[self.index]
+
+    @valid_until.setter
+    def valid_until(self, valid_until):
+        self.table.valid_until[self.index] = valid_until
+
+    @property
+    def leases(self):
+        """Leases by address. Read only, use add_lease and remove_lease."""
+        return self.table.leases.get(self.index, NO_LEASES)
+
+    @property
+    def free(self):
+        """Bitmap of free addresses, bit i is address network + i"""
+        return self.table.free.get(self.index, self.table.all_free)
+
+    @free.setter
+    def free(self, free):
+        if free == self.table.all_free:
+            self.table.free.pop(self.index, None)
+        else:
+            self.table.free[self.index] = free
+
+    @property
+    def usage(self):
+        return self.table.usage[self.index]
+
+    def transition(self, state, addr=None):
+        """Sets state and the claiming peer addr. All state changes go through
+           here, so the listener can keep its indexes up to date."""
+        old_state, old_addr = self.state, self.addr
+
+        if state == old_state and addr == old_addr:
+            return
+
+        self.table.transition(self.index, state, addr)
+
+        if self.table.listener:
+            self.table.listener.block_transition(self, old_state, old_addr)
 
     def reset(self):
-        self.state = BlockState.FREE
+        for addr in list(self.leases.keys()):
+            self.remove_lease(addr)
+
+        self.transition(BlockState.FREE)
         self.valid_until = 0
-        self.addr = None
-        self.leases = dict()
+
+        # Free blocks need no lease storage
+        self.table.leases.pop(self.index, None)
+        self.table.free.pop(self.index, None)
+
+        if self.table.listener:
+            self.table.listener.block_reset(self)
 
     def reset_if_due(self, now):
-        if self.state not in (BlockState.FREE, BlockState.BLOCKED)  and self.valid_until - now < 0:
+        if self.state not in (BlockState.FREE, BlockState.BLOCKED)  and self.valid_until - now <= 0:
             self.reset()
 
-    @property
-    def usage(self):
-        return len(self.leases)
+    def load_lease(self, lease):
+        """Stores lease without notifying the listener."""
+        table, index, addr = self.table, self.index, lease.addr
+
+        try:
+            leases = table.leases[index]
+        except KeyError:
+            leases = table.leases[index] = dict()
+
+        if addr not in leases:
+            table.usage[index] += 1
+
+        leases[addr] = lease
+
+        offset = addr - table.prefix_address - (index << table.block_bits)
+        table.free[index] = table.free.get(index, table.all_free) & ~(1 << offset)
+
+    def load_leases(self, leases):
+        """Stores a dict of leases by address in an empty block without
+           notifying the listener. The block keeps the dict."""
+        table, index = self.table, self.index
+        network = self.network
+        free = table.all_free
+
+        for addr in leases:
+            free &= ~(1 << (addr - network))
+
+        table.leases[index] = leases
+        table.usage[index] = len(leases)
+        self.free = free
+
+    def add_lease(self, lease):
+        self.load_lease(lease)
+
+        if self.table.listener:
+            self.table.listener.lease_added(self, lease)
+
+    def remove_lease(self, addr):
+        lease = self.table.leases[self.index].pop(addr)
+        self.table.usage[self.index] -= 1
+        self.free |= 1 << (addr - self.network)
+
+        if self.table.listener:
+            self.table.listener.lease_removed(self, lease)
+
+        return lease
 
-    def hosts(self):
-        return set(self.subnet.hosts()) | set([self.subnet.network_address, self.subnet.broadcast_address])
+    def free_address(self):
+        """Returns the lowest free address or None if the block is full."""
+        if not self.free:
+            return None
 
-    def purge_leases(self, now):
-        self.leases = dict(map(lambda l: (l.addr, l), filter(lambda l: l.isValid(now), self.leases.values())))
+        return self.network + (self.free & -self.free).bit_length() - 1
 
     def hasFreeAddress(self):
-        return bool(self.hosts() - set(self.leases.keys()))
+        return self.free != 0
 
     def release(self, addr, client_id):
         """Release a lease if it exists."""
@@ -55,7 +219,7 @@ class Block:
         try:
             lease = self.leases[addr]
             if lease.client_id == client_id:
-                del self.leases[addr]
+                self.remove_lease(addr)
         except KeyError:
             pass
 
@@ -64,8 +228,12 @@ class Block:
            Raises KeyError in case of failure."""
 
         if addr is None:
-            addr = (self.hosts() - set(self.leases.keys())).pop()
-        elif not self.subnet.overlaps(IPv4Network(addr)):
+            addr = self.free_address()
+
+            if addr is None:
+                raise KeyError("No free address in block")
+
+        elif not self.network <= addr < self.network + self.size:
             raise KeyError("Address not managed by this block")
 
         try:
@@ -76,20 +244,187 @@ class Block:
             lease.addr = addr
             lease.client_id = client_id
             lease.routers = routers
-            self.leases[addr] = lease
 
             if f:
                 f(now, lease)
 
+            lease.renew(now)
+            self.add_lease(lease)
+
+            return lease
+
         if lease.client_id != client_id:
             raise KeyError("client_id does not match lease")
 
         lease.renew(now)
 
+        if self.listener:
+            self.listener.lease_renewed(self, lease)
+
         return lease
 
     def __repr__(self):
-        return "Block(%s, index=%i, state=%s, valid_until=%i, addr=%s, leases=[%s])"  % (self.subnet, self.index, self.state, self.valid_until, self.addr, ", ".join(map(repr, self.leases.values())))
+        return "Block(%s/%i, index=%i, state=%s, valid_until=%i, addr=%s, leases=[%s])"  % (IPv4Address(self.network), 32 - self.size.bit_length() + 1, self.index, self.state, self.valid_until, self.addr, ", ".join(map(repr, self.leases.values())))
+
+
+class BlockSet:
+    """The blocks of a BlockTable in one state, as an array of indexes.
+       O(1) add, discard and random choice."""
+
+    def __init__(self, table, state, items):
+        self.table = table
+        self.value = state.value
+        self.items = items
+
+    def __contains__(self, block):
+        return self.table.state[block.index] == self.value
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        # Iterate over a copy, transitions reorder the items
+        table = self.table
+        return (Block(table, index) for index in array("I", self.items))
+
+    def add(self, index):
+        self.table.positions[index] = len(self.items)
+        self.items.append(index)
+
+    def discard(self, index):
+        position = self.table.positions[index]
+
+        # Move the last item into the gap
+        last = self.items.pop()
+
+        if position < len(self.items):
+            self.items[position] = last
+            self.table.positions[last] = position
+
+    def sample(self, k):
+        positions = random.sample(range(len(self.items)), min(k, len(self.items)))
+
+        return [Block(self.table, self.items[i]) for i in positions]
+
+
+class BlockTable:
+    """All blocks of the pool in typed arrays, one entry per block. Leases
+       and free bitmaps are only stored for blocks that have leases, so a
+       table of free blocks costs about 25 bytes per block.
+
+       Indexing the table returns Block views."""
+
+    def __init__(self, prefix_address, nblocks, blocksize, listener=None):
+        self.prefix_address = prefix_address
+        self.blocksize = blocksize
+        self.block_bits = blocksize.bit_length() - 1
+        self.all_free = (1 << blocksize) - 1
+        self.listener = listener
+        self.nblocks = nblocks
+
+        self.state = array("B", [BlockState.FREE.value]) * nblocks
+        self.valid_until = array("d", [0]) * nblocks
+        self.usage = array("I", [0]) * nblocks
+
+        # Claiming peer as index into peers, 0 is nobody
+        self.owner = array("I", [0]) * nblocks
+        self.peers = [None]
+        self.peer_ids = {None: 0}
+
+        # index -> dict of leases by address, index -> free bitmap
+        self.leases = dict()
+        self.free = dict()
+
+        # Blocks by state. positions holds the position of each block in
+        # the items of its state.
+        self.positions = array("I", range(nblocks))
+        self.by_state = dict((state, BlockSet(self, state, array("I"))) for state in BlockState)
+        self.by_state[BlockState.FREE].items = array("I", range(nblocks))
+
+    def __len__(self):
+        return self.nblocks
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Block(self, i) for i in range(*index.indices(self.nblocks))]
+
+        if index < 0:
+            index += self.nblocks
+
+        if not 0 <= index < self.nblocks:
+            raise IndexError("block index out of range")
+
+        return Block(self, index)
+
+    def __iter__(self):
+        return (Block(self, i) for i in range(self.nblocks))
+
+    def peer_id(self, addr):
+        try:
+            return self.peer_ids[addr]
+        except KeyError:
+            self.peers.append(addr)
+            self.peer_ids[addr] = len(self.peers) - 1
+            return self.peer_ids[addr]
+
+    def transition(self, index, state, addr):
+        old = self.state[index]
+
+        if old != state.value:
+            self.by_state[STATES[old]].discard(index)
+            self.by_state[state].add(index)
+            self.state[index] = state.value
+
+        self.owner[index] = self.peer_id(addr)
+
+    def count(self, state):
+        """Counts blocks in state by scanning the state array."""
+        return self.state.count(state.value)
+
+
+class FillIndex:
+    """Our blocks bucketed by usage. Picks the fullest block that still has
+       a free address without sorting all blocks."""
+
+    def __init__(self, blocksize):
+        self.blocksize = blocksize
+        self.buckets = [dict() for i in range(blocksize + 1)]
+        self.usage = dict()
+
+        # Free addresses in all blocks
+        self.free = 0
+
+    def __contains__(self, block):
+        return block in self.usage
+
+    def __len__(self):
+        return len(self.usage)
+
+    def update(self, block):
+        self.discard(block)
+
+        self.buckets[block.usage][block] = None
+        self.usage[block] = block.usage
+        self.free += self.blocksize - block.usage
+
+    def discard(self, block):
+        usage = self.usage.pop(block, None)
+
+        if usage is not None:
+            del self.buckets[usage][block]
+            self.free -= self.blocksize - usage
+
+    def empty(self):
+        """Returns the blocks without leases."""
+        return list(self.buckets[0])
+
+    def fullest(self):
+        """Returns the fullest block with a free address or None."""
+        for usage in range(len(self.buckets) - 2, -1, -1):
+            for block in self.buckets[usage]:
+                return block
+
+        return None
 
 
 def wrap_housekeeping(f):
@@ -97,106 +432,202 @@ def wrap_housekeeping(f):
         try:
             return f(self, *args, **kwargs)
         finally:
-            self.loop.create_task(self.housekeeping())
+            self.schedule_housekeeping()
 
     return inner
 
 
 class DDHCP:
-    def __init__(self, config):
+    def __init__(self, config, clock=time.time):
         # TODO hier etwas aufräumen. config reicht evtl...
         self.config = config
         self.id = random.getrandbits(64)
-        nAddresses = config["prefix"].num_addresses
-        prefixDiff = int(32 - log(config["blocksize"], 2) - config["prefix"].prefixlen)
-        subnets = config["prefix"].subnets(prefixlen_diff=prefixDiff)
+        # Source of the current time, replaced by the simulator
+        self.clock = clock
+        # Blocks are aligned to the prefix, so the block index of an address
+        # is just its offset into the prefix shifted by the block size.
+        self.prefix_address = int(config["prefix"].network_address)
+        self.block_bits = config["blocksize"].bit_length() - 1
+        nblocks = config["prefix"].num_addresses >> self.block_bits
+
+        # Persistent journal of our claims and leases (see journal.py)
+        self.journal = None
+
+        # Our blocks ordered by fill level
+        self.fill = FillIndex(config["blocksize"])
+
+        # client_id -> list of leases held by that client
+        self.clients = dict()
+
+        # Deadlines of our leases and of blocks claimed by others
+        self.expiry = ExpiryHeap()
 
-        self.blocks = list(map(Block, subnets))
+        # Leases in blocks of peers, recently confirmed by them
+        self.peer_leases = PeerLeaseCache(config["peerleasecache"], config["peerleasewindow"])
 
-        for i, block in enumerate(self.blocks):
-            block.index = i
+        self.blocks = BlockTable(self.prefix_address, nblocks, config["blocksize"], self)
+
+        # Blocks by state, kept up to date by the table, and blocks CLAIMED
+        # by each peer, kept up to date by block_transition
+        self.by_state = self.blocks.by_state
+        self.peer_blocks = dict()
 
         for i in config["blocked"]:
-            self.blocks[i].state = BlockState.BLOCKED
+            self.blocks[i].transition(BlockState.BLOCKED)
 
         self.own_blocks = dict()
 
-        self.lease_queues = dict()
+        # Lease options as handed out to clients
+        self.routers = list(map(int, config["routers"]))
+        self.dns = list(map(int, config["dns"]))
+
+        # Blocks being claimed, block -> future of the outcome
+        self.claims = dict()
+
+        # Forwarded lease requests, addr -> (future, start time, timeout)
+        self.peer_requests = dict()
+
+        # Our blocks whose claim changed since the last announcement
+        self.changed_claims = set()
 
         self.housekeeping_lock = asyncio.Lock()
         self.housekeeping_call = None
+        # Time of the next planned housekeeping run
+        self.housekeeping_deadline = None
+        self.housekeeping_task = None
+        self.housekeeping_dirty = False
+        self.housekeeping_stats = dict(triggered=0, coalesced=0, executed=0)
+
+        # New leases per second and how long claiming blocks takes, sizing
+        # the spares in "adaptive" sparemode
+        self.demand = DemandEstimator(config["demandhalflife"], self.clock())
+        self.claim_latency = 0.6
+
+        metrics.gauge("ddhcp_our_blocks", "Blocks claimed by this node", lambda: len(self.fill))
+        metrics.gauge("ddhcp_free_blocks", "Blocks not claimed by any node", lambda: len(self.by_state[BlockState.FREE]))
+        metrics.gauge("ddhcp_leases", "Leases in our blocks", self.lease_count)
+        metrics.gauge("ddhcp_spare_addresses", "Free addresses in our blocks", lambda: self.fill.free)
+        metrics.gauge("ddhcp_demand_rate", "Estimated new leases per second", lambda: self.demand.rate(self.clock()))
+        metrics.gauge("ddhcp_spare_target", "Free addresses housekeeping aims for", lambda: self.spare_target(self.clock()))
 
     def block_from_ip(self, addr):
-        """Given an IPv4Address return the block (or KeyError exception)"""
-        net = IPv4Network(addr)
+        """Given an address return the block (or KeyError exception)"""
+        index = (addr - self.prefix_address) >> self.block_bits
 
-        for block in self.blocks:
-            if block.subnet.overlaps(net):
-                return block
+        if index < 0 or index >= self.blocks.nblocks:
+            raise KeyError("Address not managed by any block")
 
-        raise KeyError("Address not managed by any block")
+        return Block(self.blocks, index)
 
     def prepare_lease(self, now, lease):
         lease.leasetime = self.config["leasetime"]
-        lease.routers = self.config["routers"]
-        lease.dns = self.config["dns"]
+        lease.routers = self.routers
+        lease.dns = self.dns
 
     @asyncio.coroutine
     def get_lease_from_peer(self, addr, client_id, peer):
-        queue = asyncio.Queue(loop=self.loop)
-        self.lease_queues[addr] = queue
-
-        msg = messages.RenewLease(addr, client_id)
-        self.protocol.msgto(msg, peer)
-
+        """Asks peer for the lease of addr. Concurrent requests for the same
+           address share one RenewLease. Returns None on timeout and raises
+           KeyError on LeaseNAK."""
         try:
-            lease = yield from asyncio.wait_for(queue.get(), timeout=3, loop=self.loop)
+            future = self.peer_requests[addr][0]
+        except KeyError:
+            future = asyncio.Future(loop=self.loop)
+            timer = self.loop.call_later(3, self.peer_request_timeout, addr)
+            self.peer_requests[addr] = (future, time.monotonic(), timer)
 
-            if lease is None:
-                raise KeyError("LeaseNAΚ from peer")
+            self.protocol.msgto_batched(messages.RenewLease(addr, client_id), peer)
 
-            return lease
+        try:
+            # A cancelled waiter must not cancel the request of the others
+            lease = yield from asyncio.shield(future)
         except asyncio.TimeoutError:
             return None
-        finally:
-            del self.lease_queues[addr]
+
+        if lease is None:
+            self.peer_leases.discard(addr)
+            raise KeyError("LeaseNAK from peer")
+
+        if lease.client_id != client_id:
+            self.peer_leases.discard(addr)
+            raise KeyError("Address is leased to another client")
+
+        self.peer_leases.put(lease, peer, self.clock())
+
+        return lease
+
+    @asyncio.coroutine
+    def refresh_peer_lease(self, addr, client_id, peer):
+        """Renews a lease served from the cache with its owner."""
+        try:
+            yield from self.get_lease_from_peer(addr, client_id, peer)
+        except KeyError:
+            # Not cached anymore, the next request asks the owner again
+            pass
+
+    def peer_request_done(self, addr, lease):
+        """Completes the peer request for addr with lease (None for a NAK).
+           Returns False if there is none."""
+        try:
+            future, start, timer = self.peer_requests.pop(addr)
+        except KeyError:
+            return False
+
+        timer.cancel()
+
+        PEER_LEASE_SECONDS.observe(time.monotonic() - start)
+        (PEER_LEASE_NAK if lease is None else PEER_LEASE_ACK).inc()
+
+        future.set_result(lease)
+
+        return True
+
+    def peer_request_timeout(self, addr):
+        future, start, timer = self.peer_requests.pop(addr)
+
+        PEER_LEASE_TIMEOUT.inc()
+        future.set_exception(asyncio.TimeoutError())
 
     @asyncio.coroutine
     @wrap_housekeeping
     def get_new_lease(self, client_id):
-        now = time.time()
-
-        blocks = self.our_blocks()
-        for block in blocks:
-            block.purge_leases(now)
+        now = self.clock()
 
         # If we already manage a lease for this client_id, return it
-        for lease in [l for sublist in [b.leases.values() for b in self.our_blocks()] for l in sublist]:
-            if lease.client_id == client_id:
-                return lease
+        lease = self.lease_for_client(client_id, now)
+        if lease:
+            return lease
 
-        blocks = filter(lambda b: b.hasFreeAddress(), blocks)
-        blocks = reversed(sorted(blocks, key=lambda b: b.usage))
+        self.demand.event(now)
 
-        try:
-            block = next(blocks)
-        except StopIteration:
+        block = self.fill.fullest()
+
+        if block is None:
             # TODO Try to get a block here?
             raise KeyError("No free block")
 
-        return block.get_lease(now, None, client_id, self.config["routers"], self.prepare_lease)
+        return block.get_lease(now, None, client_id, self.routers, self.prepare_lease)
 
     @asyncio.coroutine
     @wrap_housekeeping
     def get_lease(self, addr, client_id):
-        now = time.time()
+        now = self.clock()
         block = self.block_from_ip(addr)
 
         if block.state == BlockState.BLOCKED:
             raise KeyError("Blocked address")
         elif block.state == BlockState.OURS:
-            return block.get_lease(now, addr, client_id, self.config["routers"], self.prepare_lease)
+            return block.get_lease(now, addr, client_id, self.routers, self.prepare_lease)
         elif block.state == BlockState.CLAIMED:
+            lease = self.peer_leases.get(addr, client_id, block.addr, now)
+
+            if lease:
+                PEER_LEASE_CACHE_HIT.inc()
+                self.loop.create_task(self.refresh_peer_lease(addr, client_id, block.addr))
+                return lease
+
+            PEER_LEASE_CACHE_MISS.inc()
+
             lease = yield from self.get_lease_from_peer(addr, client_id, block.addr)
 
             if lease:
@@ -207,7 +638,7 @@ class DDHCP:
             result = yield from self.claim_block(block)
             if result:
                 # This is block is now managed by us.
-                return block.get_lease(now, addr, client_id, self.config["routers"], self.prepare_lease)
+                return block.get_lease(now, addr, client_id, self.routers, self.prepare_lease)
 
             # Try to reach peer again (addr might have changed)
             if block.state == BlockState.CLAIMED:
@@ -224,7 +655,7 @@ class DDHCP:
 
     @wrap_housekeeping
     def release(self, addr, client_id):
-        logging.debug("Releasing IP %s for client %s", addr, client_id)
+        log.debug("ddhcp.release", addr=Address(addr), client=Hex(client_id))
 
         block = self.block_from_ip(addr)
 
@@ -232,49 +663,289 @@ class DDHCP:
             block.release(addr, client_id)
 
         elif block.state == BlockState.CLAIMED:
+            self.peer_leases.discard(addr)
+
             msg = messages.Release(addr, client_id)
             self.protocol.msgto(msg, block.addr)
 
+    def lease_count(self):
+        return len(self.fill) * self.config["blocksize"] - self.fill.free
+
+    def lease_for_client(self, client_id, now):
+        """Returns a valid lease held by client_id or None."""
+        for lease in self.clients.get(client_id, ()):
+            if lease.isValid(now):
+                return lease
+
+        return None
+
+    def lease_added(self, block, lease):
+        if block in self.fill:
+            self.fill.update(block)
+            self.claim_changed(block)
+
+        self.clients.setdefault(lease.client_id, []).append(lease)
+        self.expiry.push(lease, lease.valid_until)
+
+        if self.journal:
+            self.journal.lease(lease)
+
+    def lease_renewed(self, block, lease):
+        self.expiry.push(lease, lease.valid_until)
+
+        if self.journal:
+            self.journal.lease(lease)
+
+    def lease_removed(self, block, lease):
+        if block in self.fill:
+            self.fill.update(block)
+            self.claim_changed(block)
+
+        leases = self.clients[lease.client_id]
+        leases.remove(lease)
+
+        if not leases:
+            del self.clients[lease.client_id]
+
+        self.expiry.discard(lease)
+
+        if self.journal:
+            self.journal.release(lease.addr)
+
+    def expire(self, now):
+        """Resets blocks and removes leases whose deadline has passed."""
+        for key in self.expiry.pop_due(now):
+            if isinstance(key, Block):
+                key.reset_if_due(now)
+                continue
+
+            block = self.block_from_ip(key.addr)
+
+            if block.leases.get(key.addr) is key and not key.isValid(now):
+                block.remove_lease(key.addr)
+
+    def check_indexes(self):
+        """Verifies all indexes against the blocks. Raises AssertionError on
+           any inconsistency. Enable config["selfcheck"] to run this after
+           every housekeeping run."""
+        clients = dict()
+        spares = 0
+
+        for block in self.blocks:
+            free = (1 << block.size) - 1
+
+            for addr, lease in block.leases.items():
+                assert lease.addr == addr, "lease %s stored under %s" % (lease, addr)
+                free &= ~(1 << (addr - block.network))
+                clients.setdefault(lease.client_id, []).append(lease)
+                assert self.expiry.deadlines.get(lease) == lease.valid_until, "%s not in expiry heap" % lease
+
+            assert block.free == free, "free bitmap of %s is out of sync" % block
+
+            if block.state == BlockState.OURS:
+                assert self.fill.usage.get(block) == block.usage, "%s not in fill index" % block
+                spares += block.size - block.usage
+            else:
+                assert block not in self.fill, "%s in fill index" % block
+
+            if block.state == BlockState.CLAIMED:
+                assert block in self.peer_blocks.get(block.addr, ()), "%s not in peer index" % block
+
+        for state, blocks in self.by_state.items():
+            assert len(blocks) == self.blocks.count(state), "state index of %s is out of sync" % state
+
+            for position, index in enumerate(blocks.items):
+                assert self.blocks.state[index] == state.value and self.blocks.positions[index] == position, "state index of %s is out of sync" % state
+
+        assert sum(map(len, self.peer_blocks.values())) == len(self.by_state[BlockState.CLAIMED]), "peer index is out of sync"
+
+        assert spares == self.fill.free, "free address count is out of sync"
+
+        assert clients.keys() == self.clients.keys(), "client index is out of sync"
+
+        for client_id, leases in clients.items():
+            assert sorted(map(id, leases)) == sorted(map(id, self.clients[client_id])), "client index is out of sync"
+
+    def block_transition(self, block, old_state, old_addr):
+        if old_state == BlockState.CLAIMED:
+            blocks = self.peer_blocks[old_addr]
+            blocks.discard(block)
+
+            if not blocks:
+                del self.peer_blocks[old_addr]
+                self.protocol.peer_gone(old_addr)
+
+        if block.state == BlockState.CLAIMED:
+            self.peer_blocks.setdefault(block.addr, set()).add(block)
+
+        if block.state == BlockState.OURS:
+            self.fill.update(block)
+
+        elif old_state == BlockState.OURS:
+            if self.journal:
+                self.journal.free(block.index)
+
+            self.fill.discard(block)
+
+    def block_reset(self, block):
+        self.expiry.discard(block)
+
+        # The block may be reassigned, leases cached from its owner are void
+        if self.peer_leases:
+            self.peer_leases.discard_block(block)
+
+    def restore(self, state):
+        """Re-asserts claims from a JournalState. Only blocks that still hold
+           unexpired leases are claimed again, together with those leases."""
+        # One object is created per lease and none of them is garbage, so
+        # cyclic garbage collection during the load is only overhead
+        enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            blocks = self.load_state(state)
+        finally:
+            if enabled:
+                gc.enable()
+
+        logging.info("Restored %i blocks with %i leases", len(blocks), sum(map(len, blocks.values())))
+
+    def load_state(self, state):
+        """Loads the leases of restore() and claims their blocks. Returns
+           the leases by address by block index."""
+        now = self.clock()
+        table = self.blocks
+        claimed = state.blocks
+        prefix_address, block_bits, nblocks = self.prefix_address, self.block_bits, table.nblocks
+        free = BlockState.FREE.value
+        routers, dns = self.routers, self.dns
+        clients = self.clients
+        deadlines = self.expiry.deadlines
+
+        # Leases are grouped by block index first, so that each block is
+        # loaded and claimed once. The per-lease hooks are bypassed, this
+        # is a bulk load of possibly many leases.
+        blocks = dict()
+
+        for addr, (leasetime, valid_until, client_id) in state.leases.items():
+            if valid_until <= now:
+                continue
+
+            index = (addr - prefix_address) >> block_bits
+
+            if index not in claimed or not 0 <= index < nblocks or table.state[index] != free:
+                continue
+
+            lease = Lease()
+            lease.addr = addr
+            lease.leasetime = leasetime
+            lease.valid_until = valid_until
+            lease.client_id = client_id
+            lease.routers = routers
+            lease.dns = dns
+
+            try:
+                blocks[index][addr] = lease
+            except KeyError:
+                blocks[index] = {addr: lease}
+
+            try:
+                clients[client_id].append(lease)
+            except KeyError:
+                clients[client_id] = [lease]
+
+            deadlines[lease] = valid_until
+
+        self.expiry.compact()
+
+        valid_until = now + self.config["blocktimeout"]
+
+        for index, leases in blocks.items():
+            block = Block(table, index)
+            block.load_leases(leases)
+            block.valid_until = valid_until
+            block.transition(BlockState.OURS)
+
+        return blocks
+
+    def snapshot(self):
+        """Replaces the journal by a snapshot of our blocks and leases."""
+        blocks = self.our_blocks()
+        leases = [(l.addr, l.leasetime, l.valid_until, l.client_id) for b in blocks for l in b.leases.values()]
+
+        self.journal.snapshot([b.index for b in blocks], leases)
+
+    @asyncio.coroutine
+    def snapshot_task(self):
+        while True:
+            yield from asyncio.sleep(self.config["snapshotinterval"])
+            self.snapshot()
+
     def set_protocol(self, protocol):
         self.protocol = protocol
 
     def free_blocks(self):
-        return list(filter(lambda d: d.state == BlockState.FREE, self.blocks))
+        return list(self.by_state[BlockState.FREE])
 
     def our_blocks(self):
-        return list(filter(lambda d: d.state == BlockState.OURS, self.blocks))
+        # The fill index holds exactly our blocks
+        return list(self.fill.usage)
 
-    def randomFreeBlock(self):
-        try:
-            return random.choice(self.free_blocks())
-        except IndexError:
-            return None
-
-    def update_claims(self):
-        blocks = self.our_blocks()
+    def update_claims(self, blocks=None):
+        """Announces the claims of blocks, by default all of our blocks.
+           Each announcement extends the claim by blocktimeout."""
+        if blocks is None:
+            blocks = self.our_blocks()
 
         msgs = []
 
-        now = time.time()
+        now = self.clock()
 
         for block in blocks:
+            block.valid_until = now + self.config["blocktimeout"]
+
             msg = messages.UpdateClaim()
             msg.block_index = block.index
-            msg.timeout = int(block.valid_until - now)
+            msg.timeout = self.config["blocktimeout"]
             msg.usage = block.usage
 
-            if msg.timeout < 0:
-                continue
-
             msgs.append(msg)
 
-        self.protocol.msgsto_group(msgs)
+        if msgs:
+            self.protocol.msgsto_group(msgs)
+
+    def claim_changed(self, block):
+        """Notes a usage change of one of our blocks. In delta mode it is
+           announced with the next slice of the refresh."""
+        if self.config["claimmode"] == "delta":
+            self.changed_claims.add(block)
 
     @asyncio.coroutine
     def update_claims_task(self):
+        if self.config["claimmode"] != "delta":
+            while True:
+                yield from asyncio.sleep(self.config["claiminterval"])
+                self.update_claims()
+
+        # In delta mode new claims and freed blocks are sent as they happen.
+        # All claims are refreshed once per claimrefresh seconds, split into
+        # claimslices slices that are sent at a random time within their
+        # share of the interval. Usage changes ride along with the next
+        # slice, so churn costs no extra datagrams.
+        slices = self.config["claimslices"]
+        slot = self.config["claimrefresh"] / slices
+
         while True:
-            yield from asyncio.sleep(self.config["claiminterval"])
-            self.update_claims()
+            for i in range(0, slices):
+                jitter = random.uniform(0, slot / 2)
+                yield from asyncio.sleep(jitter)
+
+                blocks = [b for b in self.our_blocks() if b.index % slices == i or b in self.changed_claims]
+                self.changed_claims = set()
+
+                self.update_claims(blocks)
+
+                yield from asyncio.sleep(slot - jitter)
 
     @asyncio.coroutine
     def start(self, loop):
@@ -282,38 +953,68 @@ class DDHCP:
 
         self.loop.create_task(self.update_claims_task())
 
+        if self.journal:
+            self.loop.create_task(self.snapshot_task())
+
+        # Re-assert claims restored from the journal
+        self.update_claims()
+
         yield from self.housekeeping()
 
     def schedule_housekeeping(self):
-        self.loop.create_task(self.housekeeping())
+        """Requests a housekeeping run. Requests arriving while a run is
+           already pending are coalesced into that run."""
+        self.housekeeping_stats["triggered"] += 1
+
+        if self.housekeeping_dirty:
+            self.housekeeping_stats["coalesced"] += 1
+            return
+
+        self.housekeeping_dirty = True
+
+        if self.housekeeping_task is None:
+            self.housekeeping_task = self.loop.create_task(self.housekeeping_runner())
+
+    @asyncio.coroutine
+    def housekeeping_runner(self):
+        try:
+            # Requests made during a run cause exactly one more run
+            while self.housekeeping_dirty:
+                self.housekeeping_dirty = False
+                yield from self.housekeeping()
+        finally:
+            self.housekeeping_task = None
 
     @asyncio.coroutine
     def housekeeping(self):
         self.housekeeping_call = None
         yield from self.housekeeping_lock.acquire()
 
+        start = time.monotonic()
+
         try:
-            now = time.time()
+            self.housekeeping_stats["executed"] += 1
 
-            for block in self.blocks:
-                block.reset_if_due(now)
+            now = self.clock()
 
-            for block in self.our_blocks():
-                block.purge_leases(now)
+            self.expire(now)
 
-            our_blocks = self.our_blocks()
+            free = self.fill.free
+            target = self.spare_target(now)
 
-            spares = len(our_blocks) * self.config["blocksize"] - sum([b.usage for b in our_blocks]) - self.config["spares"]
-            spare_blocks = abs(spares/self.config["blocksize"])
+            # Blocks are only freed above a higher mark, so the number of
+            # blocks doesn't flap around the target
+            if self.config["sparemode"] == "adaptive":
+                surplus = free - ceil(target * self.config["sparehysteresis"])
+            else:
+                surplus = free - target
 
-            if spares < 0:
+            if free < target:
                 # too few spares. claim additional blocks
-                yield from self.claim_n_blocks(ceil(spare_blocks))
-
-            elif spares > 0:
-                empty_blocks = list(filter(lambda b: b.usage == 0, our_blocks))
+                yield from self.claim_n_blocks(ceil((target - free) / self.config["blocksize"]))
 
-                for block in empty_blocks[0:floor(spare_blocks)]:
+            elif surplus > 0:
+                for block in self.fill.empty()[0:floor(surplus / self.config["blocksize"])]:
                     block.reset()
 
                     msg = messages.UpdateClaim()
@@ -325,90 +1026,185 @@ class DDHCP:
 
                     logging.info("Freed block %s", block)
 
-            for block in self.our_blocks():
-                # Update all timeouts of our blocks
-                block.valid_until = now + self.config["blocktimeout"]
+            # Claims of our blocks are extended by update_claims, run at
+            # least every blocktimeout / 2 for deadlines of others
+            timeout = now + self.config["blocktimeout"] / 2
 
+            deadline = self.expiry.next_deadline()
+            if deadline is not None:
+                timeout = min(timeout, deadline)
 
-            timeouts = [now + self.config["blocktimeout"] / 2] # Increase blockleastime early
-            timeouts += [b.valid_until for b in self.blocks]
-            timeouts += [l.valid_until for sublist in [b.leases.values() for b in self.our_blocks()] for l in sublist]
+            if self.housekeeping_call:
+                self.housekeeping_call.cancel()
 
-            try:
-                timeout = min(filter(lambda t: t > now, timeouts))
+            self.housekeeping_call = self.loop.call_later(timeout - now, self.schedule_housekeeping)
+            self.housekeeping_deadline = timeout
 
-                if self.housekeeping_call:
-                    self.housekeeping_call.cancel()
+        finally:
+            HOUSEKEEPING_SECONDS.observe(time.monotonic() - start)
+            self.housekeeping_lock.release()
 
-                self.housekeeping_call = self.loop.call_later(timeout - now, self.schedule_housekeeping)
+            if self.config.get("selfcheck"):
+                self.check_indexes()
 
-            except ValueError:
-                # no timeout due
-                pass
+    def spare_target(self, now):
+        """Number of free addresses to keep in our blocks."""
+        if self.config["sparemode"] != "adaptive":
+            return self.config["spares"]
 
-        finally:
-            self.housekeeping_lock.release()
+        # Cover the new leases expected until more blocks could be claimed
+        expected = self.demand.rate(now) * self.claim_latency * self.config["sparefactor"]
+
+        return max(self.config["spares"], ceil(expected))
 
     @asyncio.coroutine
     def claim_n_blocks(self, n):
+        """Claims n random free blocks in parallel. Blocks lost to other
+           nodes are replaced by new candidates, up to three times. Returns
+           the claimed blocks."""
         logging.info("Attempting to claim %i additional blocks.", n)
 
-        for i in range(0, n):
-            yield from self.claim_any_block()
+        start = self.clock()
+        claimed = []
+        inquired = False
 
-    @asyncio.coroutine
-    def claim_any_block(self):
-        block = self.randomFreeBlock()
+        free = self.by_state[BlockState.FREE]
 
-        if not block:
-            return None
+        for attempt in range(0, 3):
+            # Free blocks being claimed already are sampled but skipped
+            sample = free.sample(n - len(claimed) + len(self.claims))
+            candidates = [block for block in sample if block not in self.claims][0:n - len(claimed)]
 
-        result = yield from self.claim_block(block)
+            if not candidates:
+                break
 
-        if result:
-            return block
-        else:
-            return None
+            inquired = True
+            claimed += yield from self.claim_blocks(candidates)
+
+            if len(claimed) >= n:
+                break
+
+        # Without candidates nothing was inquired and the time says nothing
+        if inquired:
+            self.claim_latency += 0.25 * (self.clock() - start - self.claim_latency)
+
+        return claimed
 
     @asyncio.coroutine
     def claim_block(self, block):
-        for i in range(0, 3):
-            msg = messages.InquireBlock()
-            msg.block_index = block.index
+        claimed = yield from self.claim_blocks([block])
 
-            self.protocol.msgto_group(msg)
-            yield from asyncio.sleep(0.2)
+        return block in claimed
 
-            if block.state != BlockState.FREE:
-                return False
+    @asyncio.coroutine
+    def claim_blocks(self, blocks):
+        """Claims blocks in parallel and returns those claimed. Blocks that
+           are already being claimed are not inquired again, their callers
+           share the outcome."""
+        futures = []
+        inquire = []
 
-        now = time.time()
+        for block in blocks:
+            try:
+                futures.append(self.claims[block])
+            except KeyError:
+                future = asyncio.Future(loop=self.loop)
+                self.claims[block] = future
+                futures.append(future)
+                inquire.append(block)
 
-        block.state = BlockState.OURS
-        block.valid_until = now + self.config["blocktimeout"]
+        if inquire:
+            yield from self.inquire_blocks(inquire)
 
-        msg = messages.UpdateClaim()
-        msg.block_index = block.index
-        msg.timeout = int(block.valid_until - now)
-        msg.usage = block.usage
+        claimed = []
 
-        self.protocol.msgto_group(msg)
+        for block, future in zip(blocks, futures):
+            if (yield from asyncio.shield(future)):
+                claimed.append(block)
 
-        logging.info("Claimed block %s", block)
+        return claimed
 
-        return True
+    @asyncio.coroutine
+    def inquire_blocks(self, blocks):
+        """Three rounds of InquireBlock for all blocks, packed into shared
+           datagrams. A block drops out as soon as someone else inquires or
+           claims it. The remaining blocks become ours."""
+        start = time.monotonic()
+        pending = blocks
+
+        try:
+            for i in range(0, 3):
+                msgs = []
+
+                for block in pending:
+                    msg = messages.InquireBlock()
+                    msg.block_index = block.index
+                    msgs.append(msg)
+
+                self.protocol.msgsto_group(msgs)
+                yield from asyncio.sleep(0.2)
+
+                for block in pending:
+                    if block.state != BlockState.FREE:
+                        CLAIM_FAILURE.inc()
+                        self.claim_done(block, False)
+
+                pending = [block for block in pending if block.state == BlockState.FREE]
+
+                if not pending:
+                    return
+
+            now = self.clock()
+            msgs = []
+
+            for block in pending:
+                block.state = BlockState.OURS
+                block.valid_until = now + self.config["blocktimeout"]
+
+                if self.journal:
+                    self.journal.claim(block.index)
+
+                msg = messages.UpdateClaim()
+                msg.block_index = block.index
+                msg.timeout = int(block.valid_until - now)
+                msg.usage = block.usage
+                msgs.append(msg)
+
+                CLAIM_SUCCESS.inc()
+                CLAIM_SECONDS.observe(time.monotonic() - start)
+
+                logging.info("Claimed block %s", block)
+
+                self.claim_done(block, True)
+
+            self.protocol.msgsto_group(msgs)
+
+        finally:
+            # Blocks still pending here were interrupted
+            for block in blocks:
+                self.claim_done(block, False)
+
+    def claim_done(self, block, claimed):
+        future = self.claims.pop(block, None)
+
+        if future is not None:
+            future.set_result(claimed)
 
-    @wrap_housekeeping
     def handle_UpdateClaim(self, msg, node, addr):
         try:
             block = self.blocks[msg.block_index]
-        except KeyError:
+        except IndexError:
             return
 
         if block.state == BlockState.BLOCKED:
             logging.warning("%s (%s) is claiming blocked block %s", node, addr, block)
             return
 
+        if block.state == BlockState.CLAIMED and block.addr == addr and msg.timeout > 0:
+            # Most claims are refreshes of claims we already know
+            self.claim_refreshed(block, msg.timeout)
+            return
+
         if block.state == BlockState.OURS:
             dispute_won = block.usage > msg.usage or (self.id < node and block.usage == msg.usage)
             logging.info("dispute %s for block %s", "WON" if dispute_won else "LOST", block)
@@ -419,19 +1215,30 @@ class DDHCP:
             # Inform winner of all our leases before we reset our block
             self.protocol.msgsto(block.leases.values(), addr)
 
+            # We lost addresses, housekeeping may need to claim more
+            self.schedule_housekeeping()
+
         block.reset()
 
         # msg.timeout == 0 frees a block
         if msg.timeout > 0:
-            block.state = BlockState.CLAIMED
-            block.addr = addr
-            block.valid_until = time.time() + msg.timeout
+            block.transition(BlockState.CLAIMED, addr)
+            self.claim_refreshed(block, msg.timeout)
+
+    def claim_refreshed(self, block, timeout):
+        block.valid_until = self.clock() + timeout
+        self.expiry.push(block, block.valid_until)
+
+        # Claims are refreshed by every peer every few seconds. Only run
+        # housekeeping if the claim expires before the next planned run.
+        if self.housekeeping_deadline is not None and block.valid_until < self.housekeeping_deadline:
+            self.schedule_housekeeping()
 
     @wrap_housekeeping
     def handle_InquireBlock(self, msg, node, addr):
         block = self.blocks[msg.block_index]
 
-        now = time.time()
+        now = self.clock()
 
         if block.state == BlockState.OURS:
             # TODO maybe sent all claimed blocks?
@@ -444,16 +1251,17 @@ class DDHCP:
         if block.state == BlockState.FREE and node < self.id:
             block.state = BlockState.TENTATIVE
             block.valid_until = now + self.config["tentativetimeout"]
+            self.expiry.push(block, block.valid_until)
 
     def handle_RenewLease(self, msg, node, addr):
-        now = time.time()
+        now = self.clock()
 
         try:
             block = self.block_from_ip(msg.addr)
 
             if block.state == BlockState.OURS:
                 try:
-                    lease = block.get_lease(now, msg.addr, msg.client_id, self.config["routers"], self.prepare_lease)
+                    lease = block.get_lease(now, msg.addr, msg.client_id, self.routers, self.prepare_lease)
                     self.protocol.msgto(lease, addr)
                 except KeyError:
                     self.protocol.msgto(messages.LeaseNAK(msg.addr), addr)
@@ -463,26 +1271,20 @@ class DDHCP:
 
     @wrap_housekeeping
     def handle_Lease(self, msg, node, addr):
-        now = time.time()
+        now = self.clock()
 
-        try:
-            queue = self.lease_queues[msg.addr]
-            self.loop.create_task(queue.put(msg))
-        except KeyError:
+        if not self.peer_request_done(msg.addr, msg):
             # Nobody was expecting the lease
             block = self.block_from_ip(msg.addr)
 
             if block.state == BlockState.OURS:
                 if not msg.addr in block.leases:
                     msg.renew(now)
-                    block.leases[msg.addr] = msg
+                    block.add_lease(msg)
 
     def handle_LeaseNAK(self, msg, node, addr):
-        try:
-            queue = self.lease_queues[msg.addr]
-            self.loop.create_task(queue.put(None))
-        except KeyError:
-            pass
+        self.peer_leases.discard(msg.addr)
+        self.peer_request_done(msg.addr, None)
 
     @wrap_housekeeping
     def handle_Release(self, msg, node, addr):
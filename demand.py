@@ -0,0 +1,37 @@
+from math import exp, log
+
+
+class DemandEstimator:
+    """Estimates the rate of events per second (new leases).
+
+       Two exponentially decaying event counts are kept, a slow one with a
+       half-life of halflife seconds and a fast one with a tenth of that.
+       The fast one picks up bursts within seconds, the slow one carries
+       the estimate through short lulls. The estimate is the larger of
+       both."""
+
+    def __init__(self, halflife, now=0):
+        self.decay = (log(2) / halflife, 10 * log(2) / halflife)
+        self.counts = [0.0, 0.0]
+        self.last = now
+
+    def advance(self, now):
+        dt = now - self.last
+
+        if dt > 0:
+            self.counts = [count * exp(-k * dt) for count, k in zip(self.counts, self.decay)]
+            self.last = now
+
+    def event(self, now):
+        self.advance(now)
+        self.counts = [count + 1 for count in self.counts]
+
+    def rates(self, now):
+        """Returns the (slow, fast) rate estimates."""
+        self.advance(now)
+
+        # In steady state a count decaying with k holds rate / k events
+        return tuple(count * k for count, k in zip(self.counts, self.decay))
+
+    def rate(self, now):
+        return max(self.rates(now))
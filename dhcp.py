@@ -5,6 +5,31 @@ from ipaddress import IPv4Address
 import dhcpoptions
 
 
+# Fixed BOOTP header. sname and file are skipped and only sliced on demand.
+HEADER = struct.Struct("!BBBBLHHLLLL16s64x128x4s")
+
+# Fixed BOOTP header as written by serialize_into()
+PACKET = struct.Struct("!BBBBLHHLLLL16s64s128s4s")
+
+
+def address_field(name):
+    """Property exposing an address stored as int under name as IPv4Address."""
+    return property(lambda self: IPv4Address(getattr(self, name)),
+                    lambda self, addr: setattr(self, name, int(addr)))
+
+
+def parse_request(data):
+    """Parses a received datagram. Returns None for anything that is not a
+       BOOTREQUEST and raises TypeError for truncated or invalid packets."""
+    if len(data) < 1 or data[0] != DHCPPacket.BOOTREQUEST:
+        return None
+
+    packet = DHCPPacket()
+    packet.deserialize(data)
+
+    return packet
+
+
 class DHCPPacket:
     BOOTREQUEST = 1
     BOOTREPLY = 2
@@ -17,77 +42,143 @@ class DHCPPacket:
         self.xid = 0
         self.secs = 0
         self.flags = 0
-        self.ciaddr = IPv4Address("0.0.0.0")
-        self.yiaddr = IPv4Address("0.0.0.0")
-        self.siaddr = IPv4Address("0.0.0.0")
-        self.giaddr = IPv4Address("0.0.0.0")
+        self._ciaddr = 0
+        self._yiaddr = 0
+        self._siaddr = 0
+        self._giaddr = 0
         self.chaddr = b""
         self.sname = b""
         self.files = b""
         self.magic = self.MAGIC
         self.options = []
 
+        # Raw options of a received packet, indexed on first access
+        self._optdata = None
+        self._optindex = None
+        self._decoded = dict()
+
+    ciaddr = address_field("_ciaddr")
+    yiaddr = address_field("_yiaddr")
+    siaddr = address_field("_siaddr")
+    giaddr = address_field("_giaddr")
+
     def isValid(self):
         """Validates packet. Checks magic values."""
-        if self.magic != self.MAGIC:
-            return false
+        return self.magic == self.MAGIC
+
+    def serialize_into(self, buf):
+        """Writes the packet to the start of bytearray buf, growing it if it
+           is too small. Returns the length of the packet."""
+        length = PACKET.size + sum(map(len, self.options)) + 1
+
+        if len(buf) < length:
+            buf.extend(bytes(length - len(buf)))
+
+        PACKET.pack_into(buf, 0, self.op, self.htype, len(self.chaddr), self.hops, self.xid,
+                         self.secs, self.flags, self._ciaddr, self._yiaddr, self._siaddr,
+                         self._giaddr, self.chaddr, self.sname, self.files, self.magic)
+
+        offset = PACKET.size
+        for option in self.options:
+            offset = option.pack_into(buf, offset)
+
+        buf[offset] = 255 # Option End
+
+        return length
 
     def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.op)
-        r += struct.pack("!B", self.htype)
-        r += struct.pack("!B", len(self.chaddr))
-        r += struct.pack("!B", self.hops)
-        r += struct.pack("!L", self.xid)
-        r += struct.pack("!H", self.secs)
-        r += struct.pack("!H", self.flags)
-        r += self.ciaddr.packed
-        r += self.yiaddr.packed
-        r += self.siaddr.packed
-        r += self.giaddr.packed
-        r += struct.pack("!16s", self.chaddr)
-        r += struct.pack("!64s", self.sname)
-        r += struct.pack("!128s", self.files)
-        r += struct.pack("!4s", self.magic)
-        r += b"".join(map(lambda o: o.serialize(), self.options))
-        r += struct.pack("!B", 255) # Option End
-        return r
-
-    def deserialize(self, f):
-        self.op = struct.unpack("!B", f.read(1))[0]
-        self.htype = struct.unpack("!B", f.read(1))[0]
-        hlen = struct.unpack("!B", f.read(1))[0]
-        self.hops = struct.unpack("!B", f.read(1))[0]
-        self.xid = struct.unpack("!L", f.read(4))[0]
-        self.secs = struct.unpack("!H", f.read(2))[0]
-        self.flags = struct.unpack("!H", f.read(2))[0]
-        self.ciaddr = IPv4Address(f.read(4))
-        self.yiaddr = IPv4Address(f.read(4))
-        self.siaddr = IPv4Address(f.read(4))
-        self.giaddr = IPv4Address(f.read(4))
-        self.chaddr = f.read(16)[0:hlen]
-        self.sname = f.read(64)
-        self.file = f.read(128)
-        self.magic = f.read(4)
-
-        while True:
-            tag = struct.unpack("!B", f.read(1))[0]
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def deserialize(self, data):
+        """Parses the fixed header of data. Options are only located and
+           decoded when they are accessed through option()."""
+        view = memoryview(data)
+
+        if len(view) < HEADER.size:
+            raise TypeError("Truncated DHCP packet")
+
+        (self.op, self.htype, hlen, self.hops, self.xid, self.secs, self.flags,
+         self._ciaddr, self._yiaddr, self._siaddr, self._giaddr,
+         chaddr, self.magic) = HEADER.unpack_from(view)
+
+        if not self.isValid():
+            raise TypeError("Invalid DHCP magic")
+
+        self.chaddr = chaddr[0:hlen]
+        self.sname = view[44:108]
+        self.file = view[108:236]
+
+        self._optdata = view[HEADER.size:]
+        self._optindex = None
+        self._decoded = dict()
+
+    def index_options(self):
+        """Returns a dict mapping option codes to (offset, length) of their
+           data. Only the first occurrence of an option is kept."""
+        if self._optindex is not None:
+            return self._optindex
+
+        data = self._optdata
+        index = dict()
+        offset = 0
+
+        while offset < len(data):
+            tag = data[offset]
 
             if tag == 0:
+                offset += 1
                 continue
 
             if tag == 255:
                 break
 
-            tlen = struct.unpack("!B", f.read(1))[0]
+            if offset + 2 > len(data) or offset + 2 + data[offset + 1] > len(data):
+                raise TypeError("Truncated DHCP option %i" % tag)
+
+            tlen = data[offset + 1]
+            index.setdefault(tag, (offset + 2, tlen))
+            offset += 2 + tlen
+
+        self._optindex = index
+
+        return index
+
+    def option(self, cls):
+        """Returns the decoded option of class cls or None if the packet does
+           not carry it. Raises TypeError for malformed options."""
+        try:
+            return self._decoded[cls.CODE]
+        except KeyError:
+            pass
+
+        if self._optdata is None:
+            return None
+
+        try:
+            offset, tlen = self.index_options()[cls.CODE]
+        except KeyError:
+            return None
+
+        option = cls()
+
+        try:
+            option.deserialize(self._optdata[offset:offset + tlen])
+        except (ValueError, IndexError, struct.error):
+            raise TypeError("Malformed DHCP option %i" % cls.CODE)
+
+        self._decoded[cls.CODE] = option
+
+        return option
+
+    def received_options(self):
+        """Decodes all known options of a received packet."""
+        if self._optdata is None:
+            return []
 
-            try:
-                option = dhcpoptions.optionmap[tag]()
-                option.deserialize(tlen, f)
-                self.options.append(option)
-            except KeyError:
-                # skip unknown option
-                f.read(tlen)
+        codes = filter(lambda code: code in dhcpoptions.optionmap, self.index_options())
+        return list(map(lambda code: self.option(dhcpoptions.optionmap[code]), codes))
 
     def __repr__(self):
-        return "DHCP(op=%i, htype=%i, hops=%i, xid=%i, secs=%i, flags=%i, ciaddr=%s, yiaddr=%s, siaddr=%s, giaddr=%s, chaddr=%s, magic=%s, options=[%s])" % (self.op, self.htype, self.hops, self.xid, self.secs, self.flags, str(self.ciaddr), str(self.yiaddr), str(self.siaddr), str(self.giaddr), binascii.hexlify(self.chaddr).decode("UTF-8"), binascii.hexlify(self.magic).decode("UTF-8"), ", ".join(map(repr, self.options)))
+        return "DHCP(op=%i, htype=%i, hops=%i, xid=%i, secs=%i, flags=%i, ciaddr=%s, yiaddr=%s, siaddr=%s, giaddr=%s, chaddr=%s, magic=%s, options=[%s])" % (self.op, self.htype, self.hops, self.xid, self.secs, self.flags, str(self.ciaddr), str(self.yiaddr), str(self.siaddr), str(self.giaddr), binascii.hexlify(self.chaddr).decode("UTF-8"), binascii.hexlify(self.magic).decode("UTF-8"), ", ".join(map(repr, self.options + self.received_options())))
@@ -1,113 +1,126 @@
+import binascii
 import struct
 from enum import Enum
 from ipaddress import IPv4Address, IPv4Network
 
 
-class SubnetMask:
+class Option:
+    """Options are written into a preallocated buffer with pack_into(buf,
+       offset), which returns the offset after the option. len() of an
+       option is its encoded length including code and length bytes."""
+
+    def serialize(self):
+        buf = bytearray(len(self))
+        self.pack_into(buf, 0)
+        return bytes(buf)
+
+
+class SubnetMask(Option):
     CODE = 1
 
     def __init__(self, prefixlen=0):
         self.prefixlen = prefixlen
 
-    def deserialize(self, len, f):
-        self.prefixlen = IPv4Network("0.0.0.0/" + str(IPv4Address(f.read(len)))).prefixlen
+    def deserialize(self, data):
+        self.prefixlen = IPv4Network("0.0.0.0/" + str(IPv4Address(bytes(data)))).prefixlen
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", 4)
-        r += IPv4Network("0.0.0.0").supernet(new_prefix=self.prefixlen).netmask.packed
-        return r
+    def __len__(self):
+        return 6
+
+    def pack_into(self, buf, offset):
+        mask = (0xffffffff << (32 - self.prefixlen)) & 0xffffffff
+        struct.pack_into("!BBL", buf, offset, self.CODE, 4, mask)
+        return offset + 6
 
     def __repr__(self):
         return "SubnetMask(%i)" % self.prefixlen
 
 
-class RouterOption:
+class RouterOption(Option):
     CODE = 3
 
     def __init__(self, addrs=[]):
         self.addrs = addrs
 
-    def deserialize(self, len, f):
+    def deserialize(self, data):
         self.addrs = []
-        for i in range(0, int(len / 4)):
-            self.addrs.append(IPv4Address(f.read(4)))
+        for i in range(0, len(data) - 3, 4):
+            self.addrs.append(IPv4Address(bytes(data[i:i + 4])))
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", len(self.addrs) * 4)
-        r += b"".join(map(lambda a: a.packed, self.addrs))
-        return r
+    def __len__(self):
+        return 2 + len(self.addrs) * 4
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BB%iL" % len(self.addrs), buf, offset, self.CODE, len(self.addrs) * 4, *map(int, self.addrs))
+        return offset + len(self)
 
     def __repr__(self):
         return "RouterOption(%s)" % (", ".join(map(repr, self.addrs)))
 
 
-class DomainNameServerOption:
+class DomainNameServerOption(Option):
     CODE = 6
 
     def __init__(self, addrs=[]):
         self.addrs = addrs
 
-    def deserialize(self, len, f):
+    def deserialize(self, data):
         self.addrs = []
-        for i in range(0, int(len / 4)):
-            self.addrs.append(IPv4Address(f.read(4)))
+        for i in range(0, len(data) - 3, 4):
+            self.addrs.append(IPv4Address(bytes(data[i:i + 4])))
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", len(self.addrs) * 4)
-        r += b"".join(map(lambda a: a.packed, self.addrs))
-        return r
+    def __len__(self):
+        return 2 + len(self.addrs) * 4
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BB%iL" % len(self.addrs), buf, offset, self.CODE, len(self.addrs) * 4, *map(int, self.addrs))
+        return offset + len(self)
 
     def __repr__(self):
         return "DomainNameServerOption(%s)" % (", ".join(map(repr, self.addrs)))
 
 
-class RequestedIPAddress:
+class RequestedIPAddress(Option):
     CODE = 50
 
     def __init__(self):
         self.addr = IPv4Address("0.0.0.0")
 
-    def deserialize(self, len, f):
-        self.addr = IPv4Address(f.read(len))
+    def deserialize(self, data):
+        self.addr = IPv4Address(bytes(data))
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", 4)
-        r += self.addr.packed
-        return r
+    def __len__(self):
+        return 6
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BBL", buf, offset, self.CODE, 4, int(self.addr))
+        return offset + 6
 
     def __repr__(self):
         return "RequestedIPAddress(%s)" % str(self.addr)
 
 
-class IPAddressLeaseTime:
+class IPAddressLeaseTime(Option):
     CODE = 51
 
     def __init__(self, time=0):
         self.time = time
 
-    def deserialize(self, len, f):
-        self.time = struct.unpack("!L", f.read(len))[0]
+    def deserialize(self, data):
+        self.time = struct.unpack("!L", data)[0]
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", 4)
-        r += struct.pack("!L", self.time)
-        return r
+    def __len__(self):
+        return 6
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BBL", buf, offset, self.CODE, 4, self.time)
+        return offset + 6
 
     def __repr__(self):
         return "IPAddressLeaseTime(%i)" % self.time
 
 
-class DHCPMessageType:
+class DHCPMessageType(Option):
     CODE = 53
 
     TYPES = Enum("Types", "DHCPDISCOVER DHCPOFFER DHCPREQUEST DHCPDECLINE DHCPACK DHCPNAK DHCPRELEASE DHCPINFORM")
@@ -115,80 +128,97 @@ class DHCPMessageType:
     def __init__(self, type=TYPES.DHCPDISCOVER):
         self.type = type
 
-    def deserialize(self, len, f):
-        self.type = self.TYPES(struct.unpack("!B", f.read(len))[0])
+    def deserialize(self, data):
+        self.type = self.TYPES(struct.unpack("!B", data)[0])
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", 1)
-        r += struct.pack("!B", self.type.value)
-        return r
+    def __len__(self):
+        return 3
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BBB", buf, offset, self.CODE, 1, self.type.value)
+        return offset + 3
 
     def __repr__(self):
         return "DHCPMessageType(%s)" % self.type.name
 
 
-class ServerIdentifier:
+class ServerIdentifier(Option):
     CODE = 54
 
     def __init__(self, addr=IPv4Address("0.0.0.0")):
         self.addr = addr
 
-    def deserialize(self, len, f):
-        self.addr = IPv4Address(f.read(4))
+    def deserialize(self, data):
+        self.addr = IPv4Address(bytes(data[0:4]))
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", 4)
-        r += self.addr.packed
-        return r
+    def __len__(self):
+        return 6
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BBL", buf, offset, self.CODE, 4, int(self.addr))
+        return offset + 6
 
     def __repr__(self):
         return "ServerIdentifier(%s)" % str(self.addr)
 
 
-class ParameterRequestList:
+class ParameterRequestList(Option):
     CODE = 55
 
     def __init__(self):
         self.list = []
 
-    def deserialize(self, len, f):
-        self.list = struct.unpack("!%iB" % len, f.read(len))
+    def deserialize(self, data):
+        self.list = tuple(data)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", len(self.list))
-        r += struct.pack("!%iB" % len(self.list), *self.list)
-        return r
+    def __len__(self):
+        return 2 + len(self.list)
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BB%iB" % len(self.list), buf, offset, self.CODE, len(self.list), *self.list)
+        return offset + len(self)
 
     def __repr__(self):
         return "ParameterRequestList(%s)" % ", ".join(map(str, self.list))
 
 
-class ClientIdentifier:
+class ClientIdentifier(Option):
     CODE = 61
 
     def __init__(self):
         self.data = bytes([0, 0])
 
-    def deserialize(self, len, f):
-        self.data = f.read(len)
+    def deserialize(self, data):
+        self.data = bytes(data)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("!B", self.CODE)
-        r += struct.pack("!B", len(self.data))
-        r += self.data
-        return r
+    def __len__(self):
+        return 2 + len(self.data)
+
+    def pack_into(self, buf, offset):
+        struct.pack_into("!BB%is" % len(self.data), buf, offset, self.CODE, len(self.data), self.data)
+        return offset + len(self)
 
     def __repr__(self):
         return "ClientIdentifier(%s)" % self.data
 
 
+class EncodedOption(Option):
+    """One or more options that are already encoded."""
+
+    def __init__(self, data=b""):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def pack_into(self, buf, offset):
+        buf[offset:offset + len(self.data)] = self.data
+        return offset + len(self.data)
+
+    def __repr__(self):
+        return "EncodedOption(%s)" % binascii.hexlify(self.data).decode("UTF-8")
+
+
 optionmap = {
     1: SubnetMask,
     3: RouterOption,
@@ -1,14 +1,32 @@
 import asyncio
-import io
 import time
 import dhcp
 import dhcpoptions
 import logging
+from eventlog import EventLogger, Hex, Address
+import metrics
 import struct
-from binascii import hexlify
 from lease import Lease
 from ipaddress import IPv4Address
 
+REQUESTS = metrics.counter("dhcp_requests_total", "DHCP requests by message type and outcome", ("type", "outcome"))
+
+DISCOVER_OFFER = REQUESTS.labels("DHCPDISCOVER", "offer")
+DISCOVER_DROP = REQUESTS.labels("DHCPDISCOVER", "drop")
+REQUEST_ACK = REQUESTS.labels("DHCPREQUEST", "ack")
+REQUEST_NAK = REQUESTS.labels("DHCPREQUEST", "nak")
+RELEASE_DONE = REQUESTS.labels("DHCPRELEASE", "release")
+DECLINE_DROP = REQUESTS.labels("DHCPDECLINE", "drop")
+OTHER_DROP = REQUESTS.labels("other", "drop")
+INVALID_DROP = REQUESTS.labels("invalid", "drop")
+
+BATCHED = metrics.counter("dhcp_batched_requests_total", "DHCP requests from receive batches by whether they had to wait", ("path",))
+BATCHED_EAGER = BATCHED.labels("eager")
+BATCHED_DEFERRED = BATCHED.labels("deferred")
+
+log = EventLogger(logging.getLogger(__name__))
+
+
 def mkEthernetPacket(dst, src, type, payload):
     r = struct.pack("!6s6sH", dst, src, type)
     r += payload
@@ -47,6 +65,105 @@ def mkUDPPacket(dst, src, payload):
     return r
 
 
+class FrameBuilder:
+    """Ethernet, IPv4 and UDP headers for unicast replies from one interface.
+
+       The headers are built once. Per frame only the destination MAC and IP,
+       the lengths and the IP checksum are patched. The checksum is completed
+       from a precomputed sum over the constant header words."""
+
+    def __init__(self, srcmac, srcaddr, srcport=67, dstport=68, ttl=255):
+        self.header = bytearray(42)
+
+        struct.pack_into("!6sH", self.header, 6, srcmac, 0x0800)
+        struct.pack_into("!BBHHHBBHLL", self.header, 14, 4 * 16 + 5, 0, 0, 0, 0, ttl, 17, 0, int(srcaddr), 0)
+        struct.pack_into("!HHHH", self.header, 34, srcport, dstport, 0, 0)
+
+        # Total length, checksum and destination are still zero here
+        self.partial = sum(struct.unpack_from("!10H", self.header, 14))
+
+    def send(self, sock, dstmac, dstaddr, payload):
+        dstaddr = int(dstaddr)
+        udplen = 8 + len(payload)
+
+        s = self.partial + 20 + udplen + (dstaddr >> 16) + (dstaddr & 0xffff)
+        s = (s & 0xffff) + (s >> 16)
+        s = (s & 0xffff) + (s >> 16)
+
+        header = self.header
+        struct.pack_into("!6s", header, 0, dstmac)
+        struct.pack_into("!H", header, 16, 20 + udplen)
+        struct.pack_into("!H", header, 24, 0xffff ^ s)
+        struct.pack_into("!L", header, 30, dstaddr)
+        struct.pack_into("!H", header, 38, udplen)
+
+        sock.sendmsg([header, payload])
+
+
+class ReplyOptions:
+    """Cache of encoded reply options.
+
+       Reply options only depend on the config and on the parameters of a
+       lease, so they are encoded once per distinct set of values. Subnet
+       mask, routers and DNS servers are only included if the client asked
+       for them in its ParameterRequestList. All config values that go into
+       an entry are part of its key, so a reloaded config never serves stale
+       options. clear() drops all entries."""
+
+    OPTIONAL = (dhcpoptions.SubnetMask.CODE, dhcpoptions.RouterOption.CODE, dhcpoptions.DomainNameServerOption.CODE)
+
+    MAXSIZE = 256
+
+    def __init__(self, config):
+        self.config = config
+        self.cache = dict()
+
+    def clear(self):
+        self.cache.clear()
+
+    def lookup(self, key, options):
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        if len(self.cache) >= self.MAXSIZE:
+            self.cache.clear()
+
+        option = dhcpoptions.EncodedOption(b"".join(map(lambda o: o.serialize(), options())))
+        self.cache[key] = option
+
+        return option
+
+    def header(self, msgtype):
+        """Server identifier and message type."""
+        siaddr = self.config["siaddr"]
+
+        return self.lookup((siaddr, msgtype), lambda: [dhcpoptions.ServerIdentifier(siaddr), dhcpoptions.DHCPMessageType(msgtype)])
+
+    def lease(self, lease, requested):
+        """Lease options trimmed to the requested option codes. requested is
+           None if the client did not send a ParameterRequestList."""
+        prefixlen = self.config["prefixlen"]
+
+        # Keyed on the optional codes the client asked for, not on its whole
+        # list, so clients differing only in other codes share an entry
+        if requested is None:
+            present = self.OPTIONAL
+        else:
+            present = tuple(code for code in self.OPTIONAL if code in requested)
+
+        def options():
+            options = [dhcpoptions.IPAddressLeaseTime(lease.leasetime),
+                       dhcpoptions.SubnetMask(prefixlen),
+                       dhcpoptions.RouterOption(list(map(IPv4Address, lease.routers))),
+                       dhcpoptions.DomainNameServerOption(list(map(IPv4Address, lease.dns)))]
+
+            return filter(lambda o: o.CODE not in self.OPTIONAL or o.CODE in present, options)
+
+        return self.lookup((prefixlen, lease.leasetime, tuple(lease.routers), tuple(lease.dns), present), options)
+
+
 class DHCPProtocol:
     def __init__(self, loop, ddhcp, rawsock, servermac):
         self.loop = loop
@@ -54,40 +171,103 @@ class DHCPProtocol:
         self.rawsock = rawsock
         self.servermac = servermac
 
+        # Replies are serialized into this buffer, it grows as needed
+        self.txbuf = bytearray(1024)
+        self.frames = FrameBuilder(servermac, ddhcp.config["siaddr"])
+        self.replies = ReplyOptions(ddhcp.config)
+
     def connection_made(self, transport):
         self.transport = transport
 
     def sendmsg(self, msg):
         broadcast = msg.flags & 1 or msg.yiaddr == IPv4Address("0.0.0.0")
 
-        if broadcast:
-            self.transport.sendto(msg.serialize(), ("<broadcast>", 68))
-        else:
-            udpPacket = mkUDPPacket(68, 67, msg.serialize())
-            ipPacket = mkIPv4Packet(msg.yiaddr, self.ddhcp.config["siaddr"], 17, udpPacket)
-            ethPacket = mkEthernetPacket(msg.chaddr, self.servermac, 0x0800, ipPacket)
+        length = msg.serialize_into(self.txbuf)
 
-            self.rawsock.send(ethPacket)
+        with memoryview(self.txbuf) as view, view[0:length] as payload:
+            if broadcast:
+                self.transport.sendto(payload, ("<broadcast>", 68))
+            else:
+                self.frames.send(self.rawsock, msg.chaddr, msg.yiaddr, payload)
 
 
     def datagram_received(self, data, addr):
-        # TODO verify packet somehow
-        req = dhcp.DHCPPacket()
-        req.deserialize(io.BytesIO(data))
+        try:
+            req = dhcp.parse_request(data)
+        except TypeError:
+            INVALID_DROP.inc()
+            return
 
-        if req.op != req.BOOTREQUEST:
+        if req is None:
+            INVALID_DROP.inc()
             return
 
         self.loop.create_task(self.handle_request(req, addr))
 
+    def datagrams_received(self, batch):
+        """Handles a batch of (data, addr) tuples read in one go.
+
+           Each request is run until it has to wait, e.g. for a peer. Only
+           those requests are handed to a Task, all others are answered
+           within this call. A request that fails is logged like a failed
+           Task and does not affect the rest of the batch."""
+        for data, addr in batch:
+            try:
+                req = dhcp.parse_request(data)
+            except TypeError:
+                INVALID_DROP.inc()
+                continue
+
+            if req is None:
+                INVALID_DROP.inc()
+                continue
+
+            coro = self.handle_request(req, addr)
+
+            try:
+                waiting = coro.send(None)
+            except StopIteration:
+                BATCHED_EAGER.inc()
+                continue
+            except Exception as e:
+                self.loop.call_exception_handler({
+                    "message": "Exception in DHCP request",
+                    "exception": e,
+                    "protocol": self,
+                })
+                continue
+
+            BATCHED_DEFERRED.inc()
+            self.defer(coro, waiting)
+
+    def defer(self, coro, waiting):
+        """Hands coro, which was started outside of a Task and yielded
+           waiting, to a Task once waiting is done. The Task runs coro
+           itself, so it can be cancelled and inspected like any other."""
+        if waiting is None:
+            self.loop.create_task(coro)
+            return
+
+        waiting.add_done_callback(lambda future: self.loop.create_task(coro))
+
     @asyncio.coroutine
     def handle_request(self, req, addr):
-        reqtype = next(filter(lambda o: o.__class__ == dhcpoptions.DHCPMessageType, req.options)).type
-
         try:
-            client_id = next(filter(lambda o: o.__class__ == dhcpoptions.ClientIdentifier, req.options)).data
-        except StopIteration:
-            client_id = req.chaddr
+            reqtype = req.option(dhcpoptions.DHCPMessageType)
+            clientid = req.option(dhcpoptions.ClientIdentifier)
+            reqip = req.option(dhcpoptions.RequestedIPAddress)
+            requested = req.option(dhcpoptions.ParameterRequestList)
+        except TypeError:
+            INVALID_DROP.inc()
+            return
+
+        if reqtype is None:
+            INVALID_DROP.inc()
+            return
+
+        reqtype = reqtype.type
+        client_id = clientid.data if clientid is not None else req.chaddr
+        requested = tuple(requested.list) if requested is not None else None
 
         msg = dhcp.DHCPPacket()
         msg.xid = req.xid
@@ -97,60 +277,59 @@ class DHCPProtocol:
         msg.chaddr = req.chaddr
         msg.htype = 1
 
-        msg.options.append(dhcpoptions.ServerIdentifier(self.ddhcp.config["siaddr"]))
-
         now = time.time()
 
         if reqtype == dhcpoptions.DHCPMessageType.TYPES.DHCPDISCOVER:
-            logging.info("%s from %s", reqtype.name, hexlify(client_id).decode("UTF-8"))
+            log.info("dhcp.discover", client=Hex(client_id), xid=req.xid)
 
-            msg.options.append(dhcpoptions.DHCPMessageType(dhcpoptions.DHCPMessageType.TYPES.DHCPOFFER))
+            msg.options.append(self.replies.header(dhcpoptions.DHCPMessageType.TYPES.DHCPOFFER))
 
             try:
                 lease = yield from self.ddhcp.get_new_lease(client_id)
             except KeyError:
+                DISCOVER_DROP.inc()
                 return
 
             msg.yiaddr = lease.addr
-            msg.options.append(dhcpoptions.IPAddressLeaseTime(lease.leasetime))
-            msg.options.append(dhcpoptions.SubnetMask(self.ddhcp.config["prefixlen"]))
-            msg.options.append(dhcpoptions.RouterOption(lease.routers))
-            msg.options.append(dhcpoptions.DomainNameServerOption(lease.dns))
+            msg.options.append(self.replies.lease(lease, requested))
 
             self.sendmsg(msg)
+            DISCOVER_OFFER.inc()
 
-            logging.info("DHCPOFFER to %s, address %s", hexlify(client_id).decode("UTF-8"), msg.yiaddr)
+            log.info("dhcp.offer", client=Hex(client_id), addr=Address(lease.addr))
 
         elif reqtype == dhcpoptions.DHCPMessageType.TYPES.DHCPREQUEST:
-            try:
-                reqip = next(filter(lambda o: o.__class__ == dhcpoptions.RequestedIPAddress, req.options)).addr
-            except StopIteration:
-                reqip = req.ciaddr
+            reqip = reqip.addr if reqip is not None else req.ciaddr
 
-            logging.info("%s from %s for %s", reqtype.name, hexlify(client_id).decode("UTF-8"), reqip)
+            log.info("dhcp.request", client=Hex(client_id), xid=req.xid, addr=Address(reqip))
 
             try:
-                lease = yield from self.ddhcp.get_lease(reqip, client_id)
+                lease = yield from self.ddhcp.get_lease(int(reqip), client_id)
 
-                msg.options.append(dhcpoptions.DHCPMessageType(dhcpoptions.DHCPMessageType.TYPES.DHCPACK))
+                msg.options.append(self.replies.header(dhcpoptions.DHCPMessageType.TYPES.DHCPACK))
                 msg.yiaddr = lease.addr
-                msg.options.append(dhcpoptions.IPAddressLeaseTime(lease.leasetime))
-                msg.options.append(dhcpoptions.SubnetMask(self.ddhcp.config["prefixlen"]))
-                msg.options.append(dhcpoptions.RouterOption(lease.routers))
-                msg.options.append(dhcpoptions.DomainNameServerOption(lease.dns))
+                msg.options.append(self.replies.lease(lease, requested))
+                REQUEST_ACK.inc()
 
-                logging.info("DHCPACK to %s for %s", hexlify(client_id).decode("UTF-8"), msg.yiaddr)
+                log.info("dhcp.ack", client=Hex(client_id), addr=Address(lease.addr))
 
             except KeyError:
-                msg.options.append(dhcpoptions.DHCPMessageType(dhcpoptions.DHCPMessageType.TYPES.DHCPNAK))
-                logging.info("DHCPNAK to %s", hexlify(client_id).decode("UTF-8"))
+                msg.options.append(self.replies.header(dhcpoptions.DHCPMessageType.TYPES.DHCPNAK))
+                REQUEST_NAK.inc()
+                log.info("dhcp.nak", client=Hex(client_id), addr=Address(reqip))
 
             self.sendmsg(msg)
 
         elif reqtype == dhcpoptions.DHCPMessageType.TYPES.DHCPRELEASE:
-            logging.info("%s from %s for %s", reqtype.name, hexlify(client_id).decode("UTF-8"), req.ciaddr)
-            self.ddhcp.release(req.ciaddr, client_id)
+            ciaddr = int(req.ciaddr)
+
+            log.info("dhcp.release", client=Hex(client_id), addr=Address(ciaddr))
+            self.ddhcp.release(ciaddr, client_id)
+            RELEASE_DONE.inc()
 
         elif reqtype == dhcpoptions.DHCPMessageType.TYPES.DHCPDECLINE:
-            logging.info("%s from %s for %s", reqtype.name, hexlify(client_id).decode("UTF-8"), req.ciaddr)
-            logging.debug("DECLINE not yet handled")
+            log.info("dhcp.decline", client=Hex(client_id), addr=Address(req.ciaddr), handled=False)
+            DECLINE_DROP.inc()
+
+        else:
+            OTHER_DROP.inc()
@@ -0,0 +1,186 @@
+import binascii
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from ipaddress import IPv4Address
+
+
+class Hex:
+    """Log argument rendered as hex when the record is formatted."""
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data).decode("UTF-8")
+
+
+class Address:
+    """Log argument for an int address, rendered when formatted."""
+    __slots__ = ("addr",)
+
+    def __init__(self, addr):
+        self.addr = addr
+
+    def __str__(self):
+        return str(IPv4Address(int(self.addr)))
+
+
+class RateLimiter:
+    """Per-event sampling and rate limits.
+
+       rates maps an event name or its prefix up to the first dot to
+       (records per second, burst). samples maps them to n, of which only
+       every n-th record is kept."""
+
+    def __init__(self, rates, samples):
+        self.rates = rates
+        self.samples = samples
+
+        # event -> [rate, burst, tokens, last, sample, seen, dropped]
+        self.state = dict()
+
+    def rule(self, event):
+        prefix = event.split(".", 1)[0]
+        rate, burst = self.rates.get(event, self.rates.get(prefix, (None, None)))
+        sample = self.samples.get(event, self.samples.get(prefix, 1))
+
+        return [rate, burst, burst, 0, sample, 0, 0]
+
+    def admit(self, event, now):
+        """Returns None if the event is to be dropped, else the number of
+           events dropped since the last admitted one."""
+        try:
+            state = self.state[event]
+        except KeyError:
+            state = self.state[event] = self.rule(event)
+
+        rate, burst, tokens, last, sample, seen, dropped = state
+
+        state[5] = seen + 1
+        if seen % sample != 0:
+            state[6] = dropped + 1
+            return None
+
+        if rate is not None:
+            tokens = min(burst, tokens + (now - last) * rate)
+            state[3] = now
+
+            if tokens < 1:
+                state[2] = tokens
+                state[6] = dropped + 1
+                return None
+
+            state[2] = tokens - 1
+
+        state[6] = 0
+        return dropped
+
+
+# Set up by setup(), None means no limits
+limiter = None
+
+
+class EventLogger:
+    """Logs events with key/value fields, e.g.
+
+         log.info("dhcp.offer", client=Hex(client_id), addr=Address(addr))
+
+       The event name is the message and is subject to the limiter. Dropped
+       events never create a record. Fields are only formatted if the record
+       is written, the first record after drops has a dropped field."""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def log(self, level, event, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        if limiter is not None:
+            dropped = limiter.admit(event, time.time())
+
+            if dropped is None:
+                return
+
+            if dropped:
+                fields["dropped"] = dropped
+
+        self.logger.log(level, event, extra={"event": event, "fields": fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, fields)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Appends the fields of event records as key=value pairs."""
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+
+        if fields:
+            text += " " + " ".join("%s=%s" % item for item in fields.items())
+
+        return text
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the QueueListener thread. Records are dropped if
+       the queue is full.
+
+       Only EventLogger records are formatted on the writer thread, their
+       fields are immutable or lazy Hex/Address. Other records may carry
+       objects the event loop keeps changing, such as blocks, so their
+       message is formatted right away."""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if not hasattr(record, "event"):
+            record.msg = record.getMessage()
+            record.args = None
+
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup(config):
+    """Configures the root logger. Returns a QueueListener that has to be
+       started and stopped at exit or None when logging synchronously.
+       Records are queued until the listener is started."""
+    formatter = KeyValueFormatter('%(asctime)s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(config["loglevel"])
+
+    global limiter
+    limiter = RateLimiter(config["lograte"], config["logsample"])
+
+    if config["logmode"] != "queue":
+        root.addHandler(stream)
+        return None
+
+    handler = DeferredQueueHandler(queue.Queue(config["logqueue"]))
+    root.addHandler(handler)
+
+    return logging.handlers.QueueListener(handler.queue, stream)
@@ -0,0 +1,69 @@
+import heapq
+import itertools
+
+
+class ExpiryHeap:
+    """Min-heap of deadlines for arbitrary keys (blocks and leases).
+
+       Pushing a new deadline for a key or discarding it leaves the old entry
+       in the heap. Such stale entries are skipped when they reach the top and
+       the heap is compacted once they outnumber the live ones."""
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = dict()
+        self.stale = 0
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def push(self, key, deadline):
+        if key in self.deadlines:
+            self.stale += 1
+
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+
+        if self.stale > len(self.deadlines) + 64:
+            self.compact()
+
+    def discard(self, key):
+        if key in self.deadlines:
+            del self.deadlines[key]
+            self.stale += 1
+
+    def compact(self):
+        self.heap = [(deadline, next(self.counter), key) for key, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+        self.stale = 0
+
+    def next_deadline(self):
+        """Returns the earliest live deadline or None."""
+        while self.heap:
+            deadline, _, key = self.heap[0]
+
+            if self.deadlines.get(key) == deadline:
+                return deadline
+
+            heapq.heappop(self.heap)
+            self.stale -= 1
+
+        return None
+
+    def pop_due(self, now):
+        """Removes and returns all keys with a deadline at or before now."""
+        due = []
+
+        while True:
+            deadline = self.next_deadline()
+
+            if deadline is None or deadline > now:
+                return due
+
+            key = heapq.heappop(self.heap)[2]
+            del self.deadlines[key]
+            due.append(key)
@@ -0,0 +1,261 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import socket
+import struct
+import zlib
+
+import eventlog
+from dhcpprotocol import DHCPProtocol, FrameBuilder
+from lease import Lease
+
+# IPC between the coordinator and its DHCP workers. Every message on the
+# SOCK_SEQPACKET socket pair starts with its type.
+#   PACKET  coordinator -> worker: a DHCP datagram from a client
+#   REQUEST worker -> coordinator: lease operation for a client
+#   REPLY   coordinator -> worker: outcome of a REQUEST, followed by the
+#           serialized Lease on success
+T_PACKET, T_REQUEST, T_REPLY = range(1, 4)
+
+REQUEST = struct.Struct("!BLBL")    # type, request id, op, addr; then client_id
+REPLY = struct.Struct("!BLB")       # type, request id, status; then lease
+
+OP_NEW_LEASE, OP_LEASE, OP_RELEASE = range(1, 4)
+
+STATUS_OK, STATUS_FAILED = range(0, 2)
+
+MAXMSG = 65536
+
+
+def shard(data, n):
+    """Picks a worker for a raw BOOTP datagram by hashing chaddr."""
+    hlen = min(data[2], 16)
+    return zlib.crc32(data[28:28 + hlen]) % n
+
+
+class ShardedFrontend:
+    """DHCP protocol for the coordinator process when DHCP is handled by
+       worker processes.
+
+       Received datagrams are passed on to a worker chosen by the client
+       hardware address without parsing them. Workers parse requests and
+       build replies themselves and only ask the coordinator, which owns the
+       DDHCP state, for lease operations."""
+
+    def __init__(self, loop, ddhcp, workers, open_rawsock):
+        self.loop = loop
+        self.ddhcp = ddhcp
+        self.nworkers = workers
+        self.open_rawsock = open_rawsock
+        self.socks = []
+        self.processes = []
+
+    def start(self):
+        """Forks the workers. Call this before starting any threads."""
+        ctx = multiprocessing.get_context("fork")
+
+        for i in range(0, self.nworkers):
+            ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+            process = ctx.Process(target=worker_main, name="dhcp-worker-%i" % i,
+                                  args=(theirs, self.ddhcp.config, self.open_rawsock))
+            process.daemon = True
+            process.start()
+            theirs.close()
+
+            ours.setblocking(False)
+            self.loop.add_reader(ours.fileno(), self.read_ready, ours)
+
+            self.socks.append(ours)
+            self.processes.append(process)
+
+        logging.info("Started %i DHCP workers", self.nworkers)
+
+    def stop(self):
+        for sock in self.socks:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 44 or data[0] != 1:
+            return
+
+        sock = self.socks[shard(data, len(self.socks))]
+
+        try:
+            sock.send(bytes([T_PACKET]) + data)
+        except BlockingIOError:
+            logging.warning("DHCP worker is not keeping up, dropping packet")
+
+    def datagrams_received(self, batch):
+        for data, addr in batch:
+            self.datagram_received(data, addr)
+
+    def read_ready(self, sock):
+        while True:
+            try:
+                data = sock.recv(MAXMSG)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            if not data:
+                logging.error("DHCP worker exited")
+                self.loop.remove_reader(sock.fileno())
+                return
+
+            if data[0] == T_REQUEST:
+                _, rid, op, addr = REQUEST.unpack_from(data)
+                self.loop.create_task(self.handle_request(sock, rid, op, addr, data[REQUEST.size:]))
+
+    @asyncio.coroutine
+    def handle_request(self, sock, rid, op, addr, client_id):
+        try:
+            if op == OP_NEW_LEASE:
+                lease = yield from self.ddhcp.get_new_lease(client_id)
+            elif op == OP_LEASE:
+                lease = yield from self.ddhcp.get_lease(addr, client_id)
+            else:
+                self.ddhcp.release(addr, client_id)
+                return
+
+            reply = REPLY.pack(T_REPLY, rid, STATUS_OK) + lease.serialize()
+
+        except KeyError:
+            reply = REPLY.pack(T_REPLY, rid, STATUS_FAILED)
+
+        try:
+            sock.send(reply)
+        except OSError as e:
+            logging.warning("Can not reply to DHCP worker: %s", e)
+
+
+class LeaseClient:
+    """Stands in for DDHCP inside a worker. Forwards lease operations to the
+       coordinator."""
+
+    def __init__(self, loop, sock, config):
+        self.loop = loop
+        self.sock = sock
+        self.config = config
+        self.pending = dict()
+        self.rid = 0
+
+    def reply_received(self, data):
+        _, rid, status = REPLY.unpack_from(data)
+
+        try:
+            future = self.pending[rid]
+        except KeyError:
+            return
+
+        if future.done():
+            return
+
+        if status == STATUS_OK:
+            lease = Lease()
+            lease.deserialize(io.BytesIO(data[REPLY.size:]))
+            future.set_result(lease)
+        else:
+            future.set_exception(KeyError("Lease request failed"))
+
+    def send(self, op, addr, client_id):
+        """Sends a request to the coordinator. Raises KeyError if the
+           socket is full, like a request the coordinator did not answer."""
+        self.rid = (self.rid + 1) & 0xffffffff
+
+        try:
+            self.sock.send(REQUEST.pack(T_REQUEST, self.rid, op, addr) + client_id)
+        except BlockingIOError:
+            raise KeyError("Coordinator is not keeping up")
+
+        return self.rid
+
+    @asyncio.coroutine
+    def request(self, op, addr, client_id):
+        future = asyncio.Future(loop=self.loop)
+        rid = self.send(op, addr, client_id)
+        self.pending[rid] = future
+
+        try:
+            return (yield from asyncio.wait_for(future, timeout=10, loop=self.loop))
+        except asyncio.TimeoutError:
+            raise KeyError("Coordinator did not answer")
+        finally:
+            del self.pending[rid]
+
+    @asyncio.coroutine
+    def get_new_lease(self, client_id):
+        return (yield from self.request(OP_NEW_LEASE, 0, client_id))
+
+    @asyncio.coroutine
+    def get_lease(self, addr, client_id):
+        return (yield from self.request(OP_LEASE, addr, client_id))
+
+    def release(self, addr, client_id):
+        try:
+            self.send(OP_RELEASE, addr, client_id)
+        except KeyError as e:
+            logging.warning("Dropping release: %s", e)
+
+
+class BroadcastTransport:
+    """Sends broadcast replies of a worker through its raw socket."""
+
+    def __init__(self, frames, rawsock):
+        self.frames = frames
+        self.rawsock = rawsock
+
+    def sendto(self, data, addr):
+        self.frames.send(self.rawsock, b"\xff" * 6, 0xffffffff, data)
+
+
+def worker_main(sock, config, open_rawsock):
+    # The log writer thread of the parent was not forked
+    logging.getLogger().handlers.clear()
+    loglistener = eventlog.setup(config)
+    if loglistener:
+        loglistener.start()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    rawsock, servermac = open_rawsock()
+
+    client = LeaseClient(loop, sock, config)
+    protocol = DHCPProtocol(loop, client, rawsock, servermac)
+    protocol.connection_made(BroadcastTransport(FrameBuilder(servermac, config["siaddr"]), rawsock))
+
+    def read_ready():
+        while True:
+            try:
+                data = sock.recv(MAXMSG)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            if not data:
+                loop.stop()
+                return
+
+            if data[0] == T_PACKET:
+                protocol.datagram_received(data[1:], None)
+            elif data[0] == T_REPLY:
+                client.reply_received(data)
+
+    sock.setblocking(False)
+    loop.add_reader(sock.fileno(), read_ready)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    if loglistener:
+        loglistener.stop()
@@ -0,0 +1,200 @@
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+
+# File header: magic, prefix address, prefix length, blocksize
+FILEHEADER = struct.Struct("!4sLBB")
+MAGIC = b"DDJ1"
+
+# Records, each starting with its type
+CLAIM = struct.Struct("!BL")        # block index
+FREE = struct.Struct("!BL")         # block index
+LEASE = struct.Struct("!BLLdB")     # addr, leasetime, valid_until, client_id length, client_id
+RELEASE = struct.Struct("!BL")      # addr
+
+T_CLAIM, T_FREE, T_LEASE, T_RELEASE = range(1, 5)
+
+
+class JournalState:
+    """State replayed from a journal: claimed block indexes and leases
+       mapping addr -> (leasetime, valid_until, client_id)."""
+
+    def __init__(self):
+        self.blocks = set()
+        self.leases = dict()
+
+    def replay(self, data, offset):
+        """Applies all records in data (bytes or mmap) starting at offset. A
+           truncated record at the end (e.g. after a crash) is ignored."""
+        end = len(data)
+
+        while offset < end:
+            rtype = data[offset]
+
+            try:
+                if rtype == T_LEASE:
+                    _, addr, leasetime, valid_until, idlen = LEASE.unpack_from(data, offset)
+                    offset += LEASE.size
+
+                    if offset + idlen > end:
+                        break
+
+                    self.leases[addr] = (leasetime, valid_until, data[offset:offset + idlen])
+                    offset += idlen
+
+                elif rtype == T_RELEASE:
+                    self.leases.pop(RELEASE.unpack_from(data, offset)[1], None)
+                    offset += RELEASE.size
+
+                elif rtype == T_CLAIM:
+                    self.blocks.add(CLAIM.unpack_from(data, offset)[1])
+                    offset += CLAIM.size
+
+                elif rtype == T_FREE:
+                    self.blocks.discard(FREE.unpack_from(data, offset)[1])
+                    offset += FREE.size
+
+                else:
+                    logging.warning("Unknown journal record %i, ignoring rest of journal", rtype)
+                    break
+
+            except struct.error:
+                break
+
+
+class Journal:
+    """Append-only journal of our block claims and leases.
+
+       Records are queued by the event loop and written by a background
+       thread, which fsyncs at most once per syncinterval seconds. snapshot()
+       replaces the journal by a compacted snapshot file. Both files share
+       one record format and are memory-mapped when loaded."""
+
+    def __init__(self, path, config, syncinterval=1):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.syncinterval = syncinterval
+        self.header = FILEHEADER.pack(MAGIC, int(config["prefix"].network_address),
+                                      config["prefix"].prefixlen, config["blocksize"])
+
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def load(self):
+        """Reads snapshot and journal. Returns a JournalState."""
+        state = JournalState()
+
+        for path in (self.snapshot_path, self.path):
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size <= FILEHEADER.size:
+                        continue
+
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        if data[0:FILEHEADER.size] != self.header:
+                            logging.warning("Journal %s does not match config, ignoring it", path)
+                            continue
+
+                        state.replay(data, FILEHEADER.size)
+
+            except FileNotFoundError:
+                pass
+
+        return state
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="journal", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Writes all queued records and stops the writer thread."""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def claim(self, index):
+        self.queue.put(CLAIM.pack(T_CLAIM, index))
+
+    def free(self, index):
+        self.queue.put(FREE.pack(T_FREE, index))
+
+    def lease(self, lease):
+        self.queue.put(LEASE.pack(T_LEASE, lease.addr, lease.leasetime, lease.valid_until, len(lease.client_id)) + lease.client_id)
+
+    def release(self, addr):
+        self.queue.put(RELEASE.pack(T_RELEASE, addr))
+
+    def snapshot(self, blocks, leases):
+        """Replaces snapshot and journal by the given state: a list of block
+           indexes and a list of (addr, leasetime, valid_until, client_id)
+           tuples. Both are encoded on the writer thread."""
+        self.queue.put((blocks, leases))
+
+    def run(self):
+        f = self.open_journal()
+        running = True
+
+        while running:
+            items = [self.queue.get()]
+
+            # Let records accumulate, this bounds the fsync rate
+            time.sleep(self.syncinterval)
+
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = []
+
+            for item in items:
+                if item is None:
+                    running = False
+                elif isinstance(item, bytes):
+                    records.append(item)
+                else:
+                    # Everything before the snapshot is part of it
+                    records = []
+                    f.close()
+                    self.write_snapshot(*item)
+                    f = self.open_journal(truncate=True)
+
+            try:
+                f.write(b"".join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError as e:
+                logging.error("Writing journal %s failed: %s", self.path, e)
+
+        f.close()
+
+    def open_journal(self, truncate=False):
+        f = open(self.path, "wb" if truncate else "ab")
+
+        if f.tell() == 0:
+            f.write(self.header)
+
+        return f
+
+    def write_snapshot(self, blocks, leases):
+        records = [self.header]
+        records += [CLAIM.pack(T_CLAIM, index) for index in blocks]
+
+        for addr, leasetime, valid_until, client_id in leases:
+            records.append(LEASE.pack(T_LEASE, addr, leasetime, valid_until, len(client_id)) + client_id)
+
+        tmp = self.snapshot_path + ".tmp"
+
+        with open(tmp, "wb") as f:
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp, self.snapshot_path)
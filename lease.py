@@ -4,10 +4,13 @@ from ipaddress import IPv4Address
 
 
 class Lease:
+    """A lease. All addresses are ints."""
     command = 17
 
+    __slots__ = ("addr", "leasetime", "valid_until", "client_id", "routers", "dns")
+
     def __init__(self):
-        self.addr = IPv4Address("0.0.0.0")
+        self.addr = 0
         self.leasetime = 0
         self.valid_until = 0
         self.client_id = b""
@@ -21,37 +24,24 @@ class Lease:
         return self.valid_until > now
 
     def deserialize(self, f):
-        self.addr = IPv4Address(f.read(4))
-        self.leasetime = struct.unpack("!L", f.read(4))[0]
-
-        idlen = struct.unpack("!B", f.read(1))[0]
+        self.addr, self.leasetime, idlen = struct.unpack("!LLB", f.read(9))
         self.client_id = f.read(idlen)
 
         n = struct.unpack("!B", f.read(1))[0]
-        self.routers = []
-        for i in range(0, n):
-            self.routers.append(IPv4Address(f.read(4)))
+        self.routers = list(struct.unpack("!%iL" % n, f.read(4 * n)))
 
         n = struct.unpack("!B", f.read(1))[0]
-        self.routers = []
-        for i in range(0, n):
-            self.dns.append(IPv4Address(f.read(4)))
+        self.dns = list(struct.unpack("!%iL" % n, f.read(4 * n)))
 
     def serialize(self):
         r = b""
-        r += self.addr.packed
-        r += struct.pack("!L", self.leasetime)
-
-        r += struct.pack("!B", len(self.client_id))
+        r += struct.pack("!LLB", self.addr, self.leasetime, len(self.client_id))
         r += self.client_id
 
-        r += struct.pack("!B", len(self.routers))
-        r += b"".join(map(lambda r: r.packed, self.routers))
-
-        r += struct.pack("!B", len(self.dns))
-        r += b"".join(map(lambda r: r.packed, self.dns))
+        r += struct.pack("!B%iL" % len(self.routers), len(self.routers), *self.routers)
+        r += struct.pack("!B%iL" % len(self.dns), len(self.dns), *self.dns)
 
         return r
 
     def __repr__(self):
-        return "Lease(addr=%s, client_id=%s, leasetime=%i)" % (self.addr, binascii.hexlify(self.client_id).decode("UTF-8"), self.leasetime)
+        return "Lease(addr=%s, client_id=%s, leasetime=%i)" % (IPv4Address(self.addr), binascii.hexlify(self.client_id).decode("UTF-8"), self.leasetime)
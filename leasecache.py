@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+
+class PeerLeaseCache:
+    """Bounded LRU cache of leases in blocks of other nodes, as confirmed by
+       their owner.
+
+       A lease is served for window times its leasetime after the owner
+       confirmed it, and only to the same client while the same peer owns
+       the block. The owner renews a lease for twice its leasetime, so a
+       window of at most 1/2 never hands out a lease beyond the owner's."""
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+
+        # addr -> (lease, peer, served until)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, lease, peer, now):
+        if self.size <= 0:
+            return
+
+        self.entries[lease.addr] = (lease, peer, now + self.window * lease.leasetime)
+        self.entries.move_to_end(lease.addr)
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, addr, client_id, peer, now):
+        """Returns the cached lease of addr or None."""
+        try:
+            lease, owner, until = self.entries[addr]
+        except KeyError:
+            return None
+
+        if owner != peer or lease.client_id != client_id or until <= now:
+            del self.entries[addr]
+            return None
+
+        self.entries.move_to_end(addr)
+
+        return lease
+
+    def discard(self, addr):
+        self.entries.pop(addr, None)
+
+    def discard_block(self, block):
+        for addr in range(block.network, block.network + block.size):
+            self.entries.pop(addr, None)
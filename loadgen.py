@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""DORA load generator for a single node.
+
+Drives DHCPProtocol and DDHCP in-process. Replies are caught by a fake
+broadcast transport and a fake raw socket, so no network is needed. Every
+simulated client runs DISCOVER/REQUEST, renews its lease and releases it,
+for a number of cycles.
+
+With --workers requests go through ShardedFrontend to forked DHCP workers,
+which send their replies back over a socket.
+
+./loadgen.py --clients 5000 --concurrency 200 --json results.json
+./loadgen.py --clients 5000 --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import dhcp
+import dhcpoptions
+from benchmark import make_config
+from ddhcp import DDHCP, BlockState
+from dhcpprotocol import DHCPProtocol
+from frontend import ShardedFrontend
+
+TYPES = dhcpoptions.DHCPMessageType.TYPES
+
+
+class Network:
+    """Stands in for the broadcast transport and the raw socket of
+       DHCPProtocol. Hands replies to the client waiting for their xid."""
+
+    def __init__(self):
+        self.pending = dict()
+        self.replies = 0
+
+    def deliver(self, data):
+        self.replies += 1
+
+        xid = struct.unpack_from("!L", data, 4)[0]
+        future = self.pending.pop(xid, None)
+
+        if future and not future.done():
+            future.set_result(data)
+
+    def sendto(self, data, addr):
+        self.deliver(bytes(data))
+
+    def sendmsg(self, buffers):
+        self.deliver(bytes(buffers[1]))
+
+
+class ReplySocket:
+    """Raw socket of a forked worker. Passes the DHCP payload of reply
+       frames back to the load generator."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def sendmsg(self, buffers):
+        self.sock.send(buffers[1])
+
+
+class LoadGenerator:
+    def __init__(self, loop, args):
+        self.loop = loop
+        self.args = args
+
+        # Leave room for all clients plus spares and don't let leases expire
+        c = make_config(args.prefix, blocked=[], leasetime=3600,
+                        spares=args.clients, blocksize=args.blocksize)
+
+        self.ddhcp = DDHCP(c)
+        self.ddhcp.loop = loop
+        self.ddhcp.protocol = self
+
+        nblocks = min(len(self.ddhcp.blocks), math.ceil(2 * args.clients / c["blocksize"]))
+        for block in self.ddhcp.blocks[0:nblocks]:
+            block.state = BlockState.OURS
+            block.valid_until = time.time() + c["blocktimeout"]
+
+        self.network = Network()
+
+        if args.workers > 0:
+            self.replies, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+            self.frontend = ShardedFrontend(loop, self.ddhcp, args.workers, lambda: (ReplySocket(theirs), bytes(6)))
+            self.frontend.start()
+            theirs.close()
+
+            self.replies.setblocking(False)
+            loop.add_reader(self.replies.fileno(), self.replies_ready)
+
+            self.receiver = self.frontend
+        else:
+            self.frontend = None
+            self.receiver = DHCPProtocol(loop, self.ddhcp, self.network, bytes(6))
+            self.receiver.connection_made(self.network)
+
+        self.xid = random.getrandbits(32)
+        self.latencies = dict((t.name, []) for t in (TYPES.DHCPDISCOVER, TYPES.DHCPREQUEST))
+        self.counts = dict(offer=0, ack=0, nak=0, renew=0, release=0, timeout=0)
+
+    # Peer messages of the node under test go nowhere
+    def msgsto(self, msgs, addr):
+        pass
+
+    def msgsto_group(self, msgs):
+        pass
+
+    def msgto(self, msg, addr):
+        pass
+
+    def msgto_group(self, msg):
+        pass
+
+    def msgto_batched(self, msg, addr):
+        pass
+
+    def peer_gone(self, addr):
+        pass
+
+    def replies_ready(self):
+        while True:
+            try:
+                data = self.replies.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            self.network.deliver(data)
+
+    def request(self, chaddr, msgtype, ciaddr=0, reqip=None):
+        self.xid = (self.xid + 1) & 0xffffffff
+
+        msg = dhcp.DHCPPacket()
+        msg.op = msg.BOOTREQUEST
+        msg.htype = 1
+        msg.xid = self.xid
+        msg.chaddr = chaddr
+        msg.ciaddr = ciaddr
+        msg.options.append(dhcpoptions.DHCPMessageType(msgtype))
+
+        if reqip is not None:
+            option = dhcpoptions.RequestedIPAddress()
+            option.addr = reqip
+            msg.options.append(option)
+
+        prl = dhcpoptions.ParameterRequestList()
+        prl.list = (1, 3, 6)
+        msg.options.append(prl)
+
+        return msg.xid, msg.serialize()
+
+    @asyncio.coroutine
+    def transact(self, chaddr, msgtype, ciaddr=0, reqip=None):
+        """Sends a request and waits for the reply. Returns the reply as
+           DHCPPacket or None on timeout."""
+        xid, data = self.request(chaddr, msgtype, ciaddr, reqip)
+
+        future = asyncio.Future(loop=self.loop)
+        self.network.pending[xid] = future
+        timer = self.loop.call_later(self.args.timeout, future.cancel)
+
+        start = time.perf_counter()
+        self.receiver.datagram_received(data, ("0.0.0.0", 68))
+
+        try:
+            data = yield from future
+        except asyncio.CancelledError:
+            self.network.pending.pop(xid, None)
+            self.counts["timeout"] += 1
+            return None
+        finally:
+            timer.cancel()
+
+        self.latencies[msgtype.name].append(time.perf_counter() - start)
+
+        reply = dhcp.DHCPPacket()
+        reply.deserialize(data)
+
+        return reply
+
+    @asyncio.coroutine
+    def client(self, n, slots, finished):
+        chaddr = struct.pack("!HL", 0x0200, n)
+
+        yield from slots.acquire()
+
+        try:
+            for cycle in range(self.args.cycles):
+                offer = yield from self.transact(chaddr, TYPES.DHCPDISCOVER)
+                if offer is None:
+                    continue
+
+                self.counts["offer"] += 1
+
+                ack = yield from self.transact(chaddr, TYPES.DHCPREQUEST, reqip=offer.yiaddr)
+                if ack is None:
+                    continue
+
+                if ack.option(dhcpoptions.DHCPMessageType).type != TYPES.DHCPACK:
+                    self.counts["nak"] += 1
+                    continue
+
+                self.counts["ack"] += 1
+
+                for i in range(self.args.renews):
+                    renewed = yield from self.transact(chaddr, TYPES.DHCPREQUEST, ciaddr=ack.yiaddr)
+                    if renewed is not None:
+                        self.counts["renew"] += 1
+
+                xid, data = self.request(chaddr, TYPES.DHCPRELEASE, ciaddr=ack.yiaddr)
+                self.receiver.datagram_received(data, ("0.0.0.0", 68))
+                self.counts["release"] += 1
+        finally:
+            slots.release()
+
+            self.remaining -= 1
+            if self.remaining == 0:
+                finished.set_result(None)
+
+    def arrivals(self):
+        """Start offsets of all clients in seconds."""
+        if self.args.arrival == "burst":
+            return [0] * self.args.clients
+
+        t = 0
+        offsets = []
+
+        for i in range(self.args.clients):
+            offsets.append(t)
+            t += random.expovariate(self.args.rate)
+
+        return offsets
+
+    def run(self):
+        slots = asyncio.Semaphore(self.args.concurrency)
+        finished = asyncio.Future(loop=self.loop)
+        self.remaining = self.args.clients
+
+        def start(n):
+            self.loop.create_task(self.client(n, slots, finished))
+
+        for n, offset in enumerate(self.arrivals()):
+            self.loop.call_later(offset, start, n)
+
+        blocks = sys.getallocatedblocks()
+        start_time = time.perf_counter()
+
+        self.loop.run_until_complete(finished)
+
+        elapsed = time.perf_counter() - start_time
+        retained = sys.getallocatedblocks() - blocks
+
+        if self.frontend:
+            # Releases are not answered, let the workers pass on the last ones
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+            self.loop.remove_reader(self.replies.fileno())
+            self.frontend.stop()
+
+        if self.ddhcp.housekeeping_call:
+            self.ddhcp.housekeeping_call.cancel()
+
+        if self.ddhcp.housekeeping_task:
+            self.ddhcp.housekeeping_task.cancel()
+            self.loop.run_until_complete(asyncio.gather(self.ddhcp.housekeeping_task, return_exceptions=True))
+
+        requests = sum(map(len, self.latencies.values())) + self.counts["release"] + self.counts["timeout"]
+
+        results = dict(requests=requests,
+                       seconds=elapsed,
+                       requests_per_second=requests / elapsed,
+                       retained_blocks_per_request=retained / max(requests, 1),
+                       counts=self.counts,
+                       latency=dict())
+
+        for name, latencies in self.latencies.items():
+            latencies.sort()
+
+            if latencies:
+                results["latency"][name] = dict(p50_ms=latencies[len(latencies) // 2] * 1e3,
+                                                p99_ms=latencies[int(len(latencies) * 0.99)] * 1e3)
+
+        return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL).decode("UTF-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000, help="number of simulated clients")
+    parser.add_argument("--concurrency", type=int, default=100, help="clients active at the same time")
+    parser.add_argument("--cycles", type=int, default=1, help="DORA/release cycles per client")
+    parser.add_argument("--renews", type=int, default=2, help="renewals per cycle")
+    parser.add_argument("--arrival", choices=("burst", "poisson"), default="burst", help="client arrival pattern")
+    parser.add_argument("--rate", type=float, default=1000, help="mean arrivals per second for --arrival poisson")
+    parser.add_argument("--timeout", type=float, default=2, help="seconds to wait for a reply")
+    parser.add_argument("--prefix", default="10.0.0.0/12", help="address pool")
+    parser.add_argument("--blocksize", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=0, help="DHCP worker processes (0 handles DHCP in-process)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Don't measure logging
+    logging.disable(logging.INFO)
+
+    results = LoadGenerator(loop, args).run()
+    results.update(revision=revision(), python=platform.python_version(), args=vars(args))
+
+    loop.close()
+
+    print("%i requests in %.2f s, %.0f requests/s" % (results["requests"], results["seconds"], results["requests_per_second"]))
+    for name, latency in results["latency"].items():
+        print("%-14s p50 %8.3f ms   p99 %8.3f ms" % (name, latency["p50_ms"], latency["p99_ms"]))
+    print("retained memory blocks per request: %.2f" % results["retained_blocks_per_request"])
+    print(", ".join("%s %i" % i for i in results["counts"].items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import binascii
 import struct
-from ipaddress import IPv4Address, IPv4Network, IPv4Address
+from ipaddress import IPv4Address
 
 from lease import Lease
 
@@ -52,67 +52,61 @@ class RenewLease:
     """Ask for a renewed lease."""
     command = 16
 
-    def __init__(self, addr=IPv4Address("0.0.0.0"), client_id=b""):
+    def __init__(self, addr=0, client_id=b""):
         self.addr = addr
         self.client_id = client_id
 
     def deserialize(self, f):
-        self.addr = IPv4Address(f.read(4))
-
-        idlen = struct.unpack("!B", f.read(1))[0]
+        self.addr, idlen = struct.unpack("!LB", f.read(5))
         self.client_id = f.read(idlen)
 
     def serialize(self):
         r = b""
-        r += self.addr.packed
-        r += struct.pack("!B", len(self.client_id))
+        r += struct.pack("!LB", self.addr, len(self.client_id))
         r += self.client_id
         return r
 
     def __repr__(self):
-        return "RenewLease(addr=%s, client_id=%s)" % (str(self.addr), binascii.hexlify(self.client_id).decode("UTF-8"))
+        return "RenewLease(addr=%s, client_id=%s)" % (IPv4Address(self.addr), binascii.hexlify(self.client_id).decode("UTF-8"))
 
 
 class LeaseNAK:
     """Deny renewal of lease."""
     command = 18
 
-    def __init__(self, addr=IPv4Address("0.0.0.0")):
+    def __init__(self, addr=0):
         self.addr = addr
 
     def deserialize(self, f):
-        self.addr = IPv4Address(f.read(4))
+        self.addr = struct.unpack("!L", f.read(4))[0]
 
     def serialize(self):
-        return self.addr.packed
+        return struct.pack("!L", self.addr)
 
     def __repr__(self):
-        return "LeaseNAK(addr=%s)" % (str(self.addr))
+        return "LeaseNAK(addr=%s)" % (IPv4Address(self.addr))
 
 
 class Release:
     """Release a lease. There will be no response."""
     command = 19
 
-    def __init__(self, addr=IPv4Address("0.0.0.0"), client_id=b""):
+    def __init__(self, addr=0, client_id=b""):
         self.addr = addr
         self.client_id = client_id
 
     def deserialize(self, f):
-        self.addr = IPv4Address(f.read(4))
-
-        idlen = struct.unpack("!B", f.read(1))[0]
+        self.addr, idlen = struct.unpack("!LB", f.read(5))
         self.client_id = f.read(idlen)
 
     def serialize(self):
         r = b""
-        r += self.addr.packed
-        r += struct.pack("!B", len(self.client_id))
+        r += struct.pack("!LB", self.addr, len(self.client_id))
         r += self.client_id
         return r
 
     def __repr__(self):
-        return "Release(addr=%s, client_id=%s)" % (str(self.addr), binascii.hexlify(self.client_id).decode("UTF-8"))
+        return "Release(addr=%s, client_id=%s)" % (IPv4Address(self.addr), binascii.hexlify(self.client_id).decode("UTF-8"))
 
 
 msgmap = {
@@ -125,10 +119,15 @@ msgmap = {
 }
 
 
+HEADER = struct.Struct("!QLBBBB")
+
+
 class Header:
-    """Header shared by all packets"""
+    """Header shared by all packets. The prefix is kept as network address
+       (an int) and prefix length."""
     def __init__(self):
-        self.prefix = IPv4Network("0.0.0.0/0")
+        self.prefix_address = 0
+        self.prefixlen = 0
         self.node = 0
         self.blocksize = 0
         self.command = 0
@@ -137,7 +136,7 @@ class Header:
 
     @property
     def msg_type(self):
-        return type(msgmap[self.command]()).__name__
+        return msgmap[self.command].__name__
 
     def append(self, payload):
         if len(self.payload) == 0:
@@ -150,21 +149,16 @@ class Header:
         self.count = len(self.payload)
 
     def deserialize(self, f):
-        self.node = struct.unpack("!Q", f.read(8))[0]
-        self.prefix = IPv4Network(f.read(4))
-        self.prefix = self.prefix.supernet(new_prefix= struct.unpack("!B", f.read(1))[0])
-        self.blocksize = struct.unpack("!B", f.read(1))[0]
-        self.command = struct.unpack("!B", f.read(1))[0]
-        self.count = struct.unpack("!B", f.read(1))[0]
+        self.node, address, self.prefixlen, self.blocksize, self.command, self.count = HEADER.unpack(f.read(HEADER.size))
+
+        if self.prefixlen > 32:
+            raise TypeError("Invalid prefix length: %i" % self.prefixlen)
+
+        self.prefix_address = address & (0xffffffff << (32 - self.prefixlen)) & 0xffffffff
 
     def serialize(self):
         r = b""
-        r += struct.pack("!Q", self.node)
-        r += self.prefix.network_address.packed
-        r += struct.pack("!B", self.prefix.prefixlen)
-        r += struct.pack("!B", self.blocksize)
-        r += struct.pack("!B", self.command)
-        r += struct.pack("!B", self.count)
+        r += HEADER.pack(self.node, self.prefix_address, self.prefixlen, self.blocksize, self.command, self.count)
 
         for payload in self.payload:
             r += payload.serialize()
@@ -172,7 +166,7 @@ class Header:
         return r
 
     def __repr__(self):
-        return "Header(node=%i, prefix=%s, blocksize=%i, command=%i, count=%i, payload=[%s])" % (self.node, self.prefix.compressed, self.blocksize, self.command, self.count, ", ".join(map(repr, self.payload)))
+        return "Header(node=%i, prefix=%s/%i, blocksize=%i, command=%i, count=%i, payload=[%s])" % (self.node, IPv4Address(self.prefix_address), self.prefixlen, self.blocksize, self.command, self.count, ", ".join(map(repr, self.payload)))
 
 
 def message_read(f):
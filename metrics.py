@@ -0,0 +1,181 @@
+import asyncio
+import bisect
+import logging
+
+
+# Upper bounds in seconds, from sub-millisecond packet handling up to
+# peer timeouts and block claims
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        n = 0
+        for bound, count in zip(self.bounds, self.counts):
+            n += count
+            yield name + "_bucket", labels + (("le", repr(float(bound))),), n
+
+        n += self.counts[-1]
+        yield name + "_bucket", labels + (("le", "+Inf"),), n
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, n
+
+
+class Family:
+    """A metric and its children, one per combination of label values.
+
+       Look up children once with labels() and keep them, recording on a
+       child is then a single attribute update."""
+
+    def __init__(self, name, help, kind, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = dict()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise TypeError("%s expects labels %s" % (self.name, ", ".join(self.labelnames)))
+
+        values = tuple(map(str, values))
+
+        try:
+            return self.children[values]
+        except KeyError:
+            child = self.factory()
+            self.children[values] = child
+            return child
+
+    def remove(self, *values):
+        """Drops the child of values, if there is one."""
+        self.children.pop(tuple(map(str, values)), None)
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s %s" % (self.name, self.kind)
+
+        for values, child in self.children.items():
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                yield format_sample(name, labels, value)
+
+
+class Gauge:
+    """A value read from fn() at scrape time."""
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s gauge" % self.name
+        yield format_sample(self.name, (), self.fn())
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+    return "%s %s" % (name, value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = dict()
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Family(name, help, "counter", labelnames, Counter))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Family(name, help, "histogram", labelnames, lambda: Histogram(buckets)))
+
+    def gauge(self, name, help, fn):
+        """Registers a gauge. A gauge of the same name is replaced, so the
+           most recently created DDHCP instance is the one reported."""
+        self.metrics[name] = Gauge(name, help, fn)
+        return self.metrics[name]
+
+    def register(self, family):
+        # Modules bind their children at import, a family is only created once
+        return self.metrics.setdefault(family.name, family)
+
+    def render(self):
+        lines = []
+
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+counter = registry.counter
+histogram = registry.histogram
+gauge = registry.gauge
+
+
+@asyncio.coroutine
+def handle_scrape(reader, writer):
+    try:
+        # Any request gets the metrics, only wait for the end of its header
+        while True:
+            line = yield from reader.readline()
+
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+        body = registry.render().encode("UTF-8")
+
+        writer.write(b"HTTP/1.0 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %i\r\n"
+                     b"\r\n" % len(body))
+        writer.write(body)
+
+        yield from writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+@asyncio.coroutine
+def serve(loop, address):
+    """Serves the metrics over HTTP. address is a (host, port) tuple or the
+       path of a Unix socket."""
+    if isinstance(address, str):
+        server = yield from asyncio.start_unix_server(handle_scrape, address, loop=loop)
+    else:
+        server = yield from asyncio.start_server(handle_scrape, *address, loop=loop)
+
+    logging.info("Serving metrics on %s", address)
+
+    return server
@@ -0,0 +1,95 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import signal
+import time
+import tracemalloc
+
+
+class Profiler:
+    """Profiling of a running daemon, toggled by signals.
+
+       SIGUSR1 starts a cProfile capture, the next SIGUSR1 stops it and
+       writes a report. SIGUSR2 does the same for tracemalloc and reports
+       the memory allocated between the two signals by source line. Nothing
+       is hooked into the interpreter while no capture is running."""
+
+    TOP = 40
+
+    def __init__(self, loop, directory):
+        self.loop = loop
+        self.directory = directory
+
+        self.profile = None
+        self.snapshot = None
+
+        # Restricts the detailed report to our own modules
+        self.ours = re.escape(os.path.dirname(os.path.abspath(__file__)))
+
+    def install(self):
+        self.loop.add_signal_handler(signal.SIGUSR1, self.toggle_profile)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.toggle_tracemalloc)
+
+    def path(self, kind, suffix):
+        return os.path.join(self.directory, "%s-%s.%s" % (kind, time.strftime("%Y%m%d-%H%M%S"), suffix))
+
+    def toggle_profile(self):
+        if self.profile is None:
+            logging.info("Starting profile")
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return
+
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+
+        # Raw data for pstats or snakeviz and a text summary
+        profile.dump_stats(self.path("profile", "prof"))
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+
+        out.write("== Own time, all functions\n")
+        stats.sort_stats("tottime").print_stats(self.TOP)
+
+        out.write("== Cumulative time, pyddhcpd\n")
+        stats.sort_stats("cumulative").print_stats(self.ours, self.TOP)
+
+        path = self.path("profile", "txt")
+        self.write(path, out.getvalue())
+
+        logging.info("Profile written to %s", path)
+
+    def toggle_tracemalloc(self):
+        if self.snapshot is None:
+            logging.info("Starting allocation tracing")
+            tracemalloc.start()
+            self.snapshot = tracemalloc.take_snapshot()
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        # Our own bookkeeping is not interesting
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        diff = snapshot.filter_traces(ignore).compare_to(self.snapshot.filter_traces(ignore), "lineno")
+        self.snapshot = None
+
+        lines = ["== Allocation growth by line, top %i" % self.TOP]
+        lines += [str(stat) for stat in diff[0:self.TOP]]
+        lines.append("== Total growth: %i KiB" % (sum(stat.size_diff for stat in diff) // 1024))
+
+        path = self.path("tracemalloc", "txt")
+        self.write(path, "\n".join(lines) + "\n")
+
+        logging.info("Allocation report written to %s", path)
+
+    def write(self, path, text):
+        try:
+            with open(path, "w") as f:
+                f.write(text)
+        except OSError as e:
+            logging.error("Can not write %s: %s", path, e)
@@ -1,13 +1,32 @@
 import messages
+import metrics
 import io
 
+
+PEER_MESSAGES = metrics.counter("ddhcp_peer_messages_total", "DDHCP messages received by peer node and type", ("node", "type"))
+
 class DDHCPProtocol:
+    # Peer nodes with their own dispatch entries and message counters,
+    # messages of further nodes are counted as "other"
+    MAXPEERS = 256
+
     def __init__(self, loop, group_addr, ddhcp, config):
         self.config = config
         self.loop = loop
         self.group_addr = group_addr
         self.ddhcp = ddhcp
         self.ddhcp.set_protocol(self)
+        self.prefix_address = int(config["prefix"].network_address)
+
+        self.prefixlen = config["prefix"].prefixlen
+        self.blocksize = config["blocksize"]
+
+        # (node, command) -> (handler, bound counter), addr -> node
+        self.dispatch = dict()
+        self.peers = dict()
+
+        # (addr, command) -> messages waiting for msgto_batched
+        self.batches = dict()
 
     def connection_made(self, transport):
         self.transport = transport
@@ -15,19 +34,24 @@ class DDHCPProtocol:
 
     def prepare_header(self):
         header = messages.Header()
-        header.prefix = self.config["prefix"]
+        header.prefix_address = self.prefix_address
+        header.prefixlen = self.config["prefix"].prefixlen
         header.blocksize = self.config["blocksize"]
         header.node = self.ddhcp.id
 
         return header
 
     def msgsto(self, msgs, addr):
-        header = self.prepare_header()
+        msgs = list(msgs)
 
-        for msg in msgs:
-            header.append(msg)
+        # A header carries at most 255 payloads
+        for i in range(0, max(len(msgs), 1), 255):
+            header = self.prepare_header()
 
-        self.transport.sendto(header.serialize(), addr)
+            for msg in msgs[i:i + 255]:
+                header.append(msg)
+
+            self.transport.sendto(header.serialize(), addr)
 
     def msgsto_group(self, msgs):
         self.msgsto(msgs, self.group_addr)
@@ -38,20 +62,81 @@ class DDHCPProtocol:
     def msgto_group(self, msg):
         self.msgsto_group([msg])
 
+    def msgto_batched(self, msg, addr):
+        """Sends msg to addr after config["peerbatch"] seconds. Messages of
+           the same type queued for the same addr meanwhile share its
+           datagram."""
+        key = (addr, msg.command)
+
+        try:
+            self.batches[key].append(msg)
+        except KeyError:
+            self.batches[key] = [msg]
+            self.loop.call_later(self.config["peerbatch"], self.flush_batch, key)
+
+    def flush_batch(self, key):
+        self.msgsto(self.batches.pop(key), key[0])
+
+    def datagrams_received(self, batch):
+        for data, addr in batch:
+            # A bad message must not drop the rest of the batch
+            try:
+                self.datagram_received(data, addr)
+            except Exception as e:
+                self.loop.call_exception_handler({
+                    "message": "Exception in peer message",
+                    "exception": e,
+                    "protocol": self,
+                })
+
     def datagram_received(self, data, addr):
         try:
             msg = messages.message_read(io.BytesIO(data))
         except TypeError:
             return
 
+        self.message_received(msg, addr)
+
+    def peer_gone(self, addr):
+        """Forgets the node at addr, e.g. because its last block went away."""
+        node = self.peers.pop(addr, None)
+
+        if node is None:
+            return
+
+        for command, msg_class in messages.msgmap.items():
+            self.dispatch.pop((node, command), None)
+            PEER_MESSAGES.remove("%016x" % node, msg_class.__name__)
+
+    def message_received(self, msg, addr):
+        """Dispatches a parsed message. The simulator hands one parsed
+           message to many nodes this way."""
         # Ignore our own packets
         if msg.node == self.ddhcp.id:
             return
 
-        if msg.prefix != self.config["prefix"] or msg.blocksize != self.config["blocksize"]:
+        if msg.prefix_address != self.prefix_address or msg.prefixlen != self.prefixlen or msg.blocksize != self.blocksize:
             return
 
-        method = getattr(self.ddhcp, "handle_" + msg.msg_type)
+        key = (msg.node, msg.command)
+        try:
+            method, counter = self.dispatch[key]
+        except KeyError:
+            method = getattr(self.ddhcp, "handle_" + msg.msg_type)
+
+            if self.peers.get(addr, msg.node) != msg.node:
+                # The node at addr restarted with a new id
+                self.peer_gone(addr)
+
+            if addr in self.peers or len(self.peers) < self.MAXPEERS:
+                self.peers[addr] = msg.node
+                counter = PEER_MESSAGES.labels("%016x" % msg.node, msg.msg_type)
+                self.dispatch[key] = method, counter
+            else:
+                counter = PEER_MESSAGES.labels("other", msg.msg_type)
+
+        counter.inc(len(msg.payload))
 
+        node = msg.node
         for payload in msg.payload:
-            method(payload, msg.node, addr)
+            method(payload, node, addr)
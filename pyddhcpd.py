@@ -9,31 +9,59 @@ import fcntl
 from protocol import DDHCPProtocol
 from dhcpprotocol import DHCPProtocol
 from ddhcp import DDHCP
+from journal import Journal
+from rxbatch import BatchReceiver
+from frontend import ShardedFrontend
+import metrics
+import eventlog
+from profiling import Profiler
 
 from config import config
 
 
 def main():
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)-8s %(message)s',
-                        datefmt='%m-%d %H:%M')
+    loglistener = eventlog.setup(config)
 
     logging.info("START")
 
     ddhcp = DDHCP(config)
     loop = asyncio.get_event_loop()
 
-
-    # DHCP Socket
-
-    def dhcp_factory():
-        # waw socket for sending unicast replies
+    def open_rawsock():
+        # raw socket for sending unicast replies
         rawsock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
         rawsock.bind((config["clientif"], 0x0800))
 
         servermac = fcntl.ioctl(rawsock.fileno(), 0x8927, struct.pack('256s', bytes(config["clientif"], "UTF-8")[:15]))[18:24]
 
-        return DHCPProtocol(loop, ddhcp, rawsock, servermac)
+        return rawsock, servermac
+
+    # Workers are forked before any thread is started
+    frontend = None
+    if config["workers"] > 0:
+        frontend = ShardedFrontend(loop, ddhcp, config["workers"], open_rawsock)
+        frontend.start()
+
+    if loglistener:
+        loglistener.start()
+
+    journal = None
+    if config["journal"]:
+        journal = Journal(config["journal"], config, config["journalsync"])
+        ddhcp.restore(journal.load())
+
+        ddhcp.journal = journal
+        ddhcp.snapshot()
+        journal.start()
+
+
+    # DHCP Socket
+
+    def dhcp_factory():
+        if frontend:
+            return frontend
+
+        return DHCPProtocol(loop, ddhcp, *open_rawsock())
 
     dhcplisten = loop.create_datagram_endpoint(dhcp_factory, family=socket.AF_INET, local_addr=("0.0.0.0", 67))
     dhcptransport, dhcpprotocol = loop.run_until_complete(dhcplisten)
@@ -67,15 +95,34 @@ def main():
     # Do not loopback multicast packets
     sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, 0)
 
+    if config["rxbatch"] > 0:
+        for t, p in ((dhcptransport, dhcpprotocol), (transport, protocol)):
+            BatchReceiver(loop, t.get_extra_info("socket"), p, config["rxbatch"]).start()
+
+    if config["profiledir"]:
+        Profiler(loop, config["profiledir"]).install()
+
+    if config["metrics"]:
+        loop.run_until_complete(metrics.serve(loop, config["metrics"]))
+
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
+    if frontend:
+        frontend.stop()
+
     dhcptransport.close()
     transport.close()
     loop.close()
 
+    if journal:
+        journal.stop()
+
+    if loglistener:
+        loglistener.stop()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,44 @@
+import collections
+import logging
+
+
+class BatchReceiver:
+    """Drains a readable datagram socket in one loop callback.
+
+       Takes over the reader that the asyncio transport installed for sock.
+       On every wakeup up to batchsize datagrams are read without blocking and
+       handed to protocol.datagrams_received() as one list of (data, addr)
+       tuples. The transport is still used for sending."""
+
+    def __init__(self, loop, sock, protocol, batchsize, bufsize=4096):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.batchsize = batchsize
+        self.bufsize = bufsize
+
+        # batch size -> number of batches of that size
+        self.batches = collections.Counter()
+
+    def start(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.loop.add_reader(self.sock.fileno(), self.read_ready)
+
+    def stop(self):
+        self.loop.remove_reader(self.sock.fileno())
+
+    def read_ready(self):
+        batch = []
+
+        while len(batch) < self.batchsize:
+            try:
+                batch.append(self.sock.recvfrom(self.bufsize))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.warning("Receive error: %s", e)
+                break
+
+        if batch:
+            self.batches[len(batch)] += 1
+            self.protocol.datagrams_received(batch)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""In-process cluster simulator.
+
+Runs many DDHCP nodes in one process on a virtual clock. Nodes talk over a
+simulated multicast bus with configurable latency, loss and partitions.
+Virtual time only advances when no node has anything to do, so minutes of
+cluster time pass in seconds.
+
+./simulator.py --nodes 200 --duration 600 --partition 200 --heal 300
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import random
+import selectors
+import sys
+import time
+
+import messages
+from benchmark import make_config
+from ddhcp import DDHCP, BlockState
+from protocol import DDHCPProtocol
+
+
+class VirtualSelector(selectors.BaseSelector):
+    """Selector that never has ready file descriptors. Waiting for a timeout
+       advances the virtual clock instead of sleeping."""
+
+    def __init__(self):
+        self.now = 0
+        self.keys = dict()
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self.keys[fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self.keys.pop(fileobj if isinstance(fileobj, int) else fileobj.fileno())
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Simulation stalled, nothing is scheduled")
+
+        self.now += timeout
+        return []
+
+    def get_map(self):
+        return self.keys
+
+    def close(self):
+        self.keys.clear()
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop on virtual time. asyncio.sleep() and call_later() use it
+       and return without waiting."""
+
+    def __init__(self):
+        self.selector = VirtualSelector()
+        super().__init__(self.selector)
+
+    def time(self):
+        return self.selector.now
+
+
+class Bus:
+    """Simulated multicast network.
+
+       Each datagram is parsed once and handed to all receivers after the
+       same delay of latency plus up to jitter seconds. Every receiver
+       drops it with probability loss. Nodes only reach nodes of their own
+       partition."""
+
+    def __init__(self, loop, group_addr, latency=0.001, jitter=0.0, loss=0.0, rng=random):
+        self.loop = loop
+        self.group_addr = group_addr
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = rng
+
+        self.nodes = dict()
+        self.partitions = dict()
+
+        # addr -> [datagrams, bytes] sent
+        self.sent = dict()
+
+    def attach(self, addr, protocol):
+        self.nodes[addr] = protocol
+        self.partitions[addr] = 0
+        self.sent[addr] = [0, 0]
+
+        return Transport(self, addr)
+
+    def partition(self, groups):
+        """Splits the nodes into groups, a list of lists of addresses. Nodes
+           not mentioned stay in group 0."""
+        for i, group in enumerate(groups):
+            for addr in group:
+                self.partitions[addr] = i + 1
+
+    def heal(self):
+        for addr in self.partitions:
+            self.partitions[addr] = 0
+
+    def reachable(self, a, b):
+        return self.partitions.get(a) == self.partitions.get(b)
+
+    def send(self, src, data, dst):
+        stats = self.sent[src]
+        stats[0] += 1
+        stats[1] += len(data)
+
+        if dst == self.group_addr:
+            receivers = [addr for addr in self.nodes if addr != src]
+        elif dst in self.nodes:
+            receivers = [dst]
+        else:
+            return
+
+        partition = self.partitions[src]
+        receivers = [addr for addr in receivers if self.partitions[addr] == partition]
+
+        if self.loss > 0:
+            receivers = [addr for addr in receivers if self.rng.random() >= self.loss]
+
+        if not receivers:
+            return
+
+        try:
+            msg = messages.message_read(io.BytesIO(data))
+        except TypeError:
+            return
+
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        self.loop.call_later(delay, self.deliver, msg, receivers, src)
+
+    def deliver(self, msg, receivers, src):
+        for addr in receivers:
+            self.nodes[addr].message_received(msg, src)
+
+
+class Transport:
+    def __init__(self, bus, addr):
+        self.bus = bus
+        self.addr = addr
+
+    def sendto(self, data, addr):
+        self.bus.send(self.addr, data, addr)
+
+
+class Cluster:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+        # DDHCP uses the random module for node ids and block choice
+        random.seed(args.seed)
+
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+
+        self.config = make_config(args.prefix, blocked=[], blocksize=args.blocksize,
+                                  spares=args.spares, claimmode=args.claimmode,
+                                  sparemode=args.sparemode)
+
+        group_addr = (self.config["mcgroup"], self.config["mcport"])
+        self.bus = Bus(self.loop, group_addr, args.latency, args.jitter, args.loss, self.rng)
+
+        self.nodes = []
+
+        for i in range(args.nodes):
+            addr = ("fe80::%x" % (i + 1), self.config["mcport"])
+            ddhcp = DDHCP(self.config, clock=self.loop.time)
+            protocol = DDHCPProtocol(self.loop, group_addr, ddhcp, self.config)
+
+            self.nodes.append((addr, ddhcp))
+            self.loop.call_later(self.rng.uniform(0, args.startup), self.start_node, addr, protocol)
+
+        self.incidents = 0
+        self.duplicates = set()
+        self.converged = dict()
+        self.leases = dict(granted=0, failed=0)
+
+    def start_node(self, addr, protocol):
+        protocol.connection_made(self.bus.attach(addr, protocol))
+
+    def owners(self):
+        """Block index -> list of nodes claiming it as OURS."""
+        owners = dict()
+
+        for addr, ddhcp in self.nodes:
+            for block in ddhcp.fill.usage:
+                owners.setdefault(block.index, []).append(addr)
+
+        return owners
+
+    def is_converged(self, owners):
+        """No block has two owners, every node has its spares and every
+           reachable node knows every claim."""
+        spares = self.config["spares"]
+
+        for addr, ddhcp in self.nodes:
+            if len(ddhcp.fill) * self.config["blocksize"] - ddhcp.lease_count() < spares:
+                return False
+
+        for index, claimants in owners.items():
+            if len(claimants) > 1:
+                return False
+
+            owner = claimants[0]
+
+            for addr, ddhcp in self.nodes:
+                if addr != owner and self.bus.reachable(addr, owner) and ddhcp.blocks[index].state != BlockState.CLAIMED:
+                    return False
+
+        return True
+
+    def sample(self, phase, since):
+        owners = self.owners()
+
+        duplicates = set(index for index, claimants in owners.items() if len(claimants) > 1)
+        self.incidents += len(duplicates - self.duplicates)
+        self.duplicates = duplicates
+
+        if phase not in self.converged and self.is_converged(owners):
+            self.converged[phase] = self.loop.time() - since
+
+    @asyncio.coroutine
+    def lease(self, ddhcp, client_id):
+        try:
+            yield from ddhcp.get_new_lease(client_id)
+            self.leases["granted"] += 1
+        except KeyError:
+            self.leases["failed"] += 1
+
+    def churn(self, ddhcp, n):
+        """Lets a node hand out leases to new clients at a Poisson rate."""
+        self.loop.create_task(self.lease(ddhcp, b"%x-%i" % (ddhcp.id, n)))
+        self.loop.call_later(self.rng.expovariate(self.args.clients), self.churn, ddhcp, n + 1)
+
+    def run(self):
+        args = self.args
+        phase, since = "startup", 0
+
+        if args.clients > 0:
+            for addr, ddhcp in self.nodes:
+                self.loop.call_later(args.startup + self.rng.expovariate(args.clients), self.churn, ddhcp, 0)
+
+        t = time.perf_counter()
+
+        while self.loop.time() < args.duration:
+            self.loop.run_until_complete(asyncio.sleep(args.sample))
+
+            now = self.loop.time()
+
+            if args.partition is not None and phase == "startup" and now >= args.partition:
+                half = [addr for addr, ddhcp in self.nodes[0:len(self.nodes) // 2]]
+                self.bus.partition([half])
+                phase, since = "partition", now
+
+            elif args.heal is not None and phase == "partition" and now >= args.heal:
+                self.bus.heal()
+                phase, since = "heal", now
+
+            self.sample(phase, since)
+
+        elapsed = time.perf_counter() - t
+
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        sent = [self.bus.sent.get(addr, (0, 0)) for addr, ddhcp in self.nodes]
+        minutes = args.duration / 60
+
+        return dict(nodes=args.nodes,
+                    virtual_seconds=self.loop.time(),
+                    wall_seconds=elapsed,
+                    convergence_seconds=self.converged,
+                    duplicate_incidents=self.incidents,
+                    duplicates_at_end=len(self.duplicates),
+                    claimed_blocks=len(self.owners()),
+                    leases=self.leases,
+                    datagrams_per_node_per_minute=dict(min=min(s[0] for s in sent) / minutes,
+                                                       mean=sum(s[0] for s in sent) / len(sent) / minutes,
+                                                       max=max(s[0] for s in sent) / minutes),
+                    bytes_per_node_per_minute=sum(s[1] for s in sent) / len(sent) / minutes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=600, help="virtual seconds to simulate")
+    parser.add_argument("--startup", type=float, default=10, help="nodes start within this many seconds")
+    parser.add_argument("--latency", type=float, default=0.005, help="one way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="additional random delay up to this many seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of losing a datagram at a receiver")
+    parser.add_argument("--partition", type=float, help="split the nodes in halves at this time")
+    parser.add_argument("--heal", type=float, help="rejoin the halves at this time")
+    parser.add_argument("--clients", type=float, default=0, help="new clients per second per node")
+    parser.add_argument("--sample", type=float, default=1, help="seconds between convergence checks")
+    parser.add_argument("--prefix", default="10.0.0.0/16")
+    parser.add_argument("--blocksize", type=int, default=16)
+    parser.add_argument("--spares", type=int, default=8)
+    parser.add_argument("--claimmode", choices=("full", "delta"), default="full")
+    parser.add_argument("--sparemode", choices=("fixed", "adaptive"), default="fixed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    results = Cluster(args).run()
+
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import logging
+
+import pytest
+
+import messages
+import simulator
+from benchmark import make_config
+from ddhcp import DDHCP, BlockState, BlockTable, FillIndex
+from expiry import ExpiryHeap
+from journal import JournalState
+from lease import Lease
+from leasecache import PeerLeaseCache
+
+PEER = ("fe80::2", 1234)
+PEER_NODE = 2 ** 63
+
+
+class Protocol:
+    """Records the peer messages of the node under test."""
+
+    def __init__(self):
+        self.sent = []
+        self.gone = []
+
+    def msgsto(self, msgs, addr):
+        self.sent.extend((msg, addr) for msg in msgs)
+
+    def msgsto_group(self, msgs):
+        self.msgsto(msgs, None)
+
+    def msgto(self, msg, addr):
+        self.sent.append((msg, addr))
+
+    def msgto_group(self, msg):
+        self.msgto(msg, None)
+
+    def msgto_batched(self, msg, addr):
+        self.msgto(msg, addr)
+
+    def peer_gone(self, addr):
+        self.gone.append(addr)
+
+
+@pytest.fixture
+def ddhcp():
+    loop = simulator.VirtualClockLoop()
+    asyncio.set_event_loop(loop)
+
+    config = make_config("10.0.0.0/24", blocked=[], blocksize=16, spares=16, leasetime=60, selfcheck=True)
+
+    ddhcp = DDHCP(config, clock=loop.time)
+    ddhcp.set_protocol(Protocol())
+    loop.run_until_complete(ddhcp.start(loop))
+
+    yield ddhcp
+
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def run(ddhcp, coro):
+    return ddhcp.loop.run_until_complete(coro)
+
+
+def advance(ddhcp, seconds):
+    """Lets virtual time pass, housekeeping runs and checks the indexes."""
+    run(ddhcp, asyncio.sleep(seconds))
+
+
+def claim(block, timeout, usage=0, node=PEER_NODE):
+    msg = messages.UpdateClaim()
+    msg.block_index = block if isinstance(block, int) else block.index
+    msg.timeout = timeout
+    msg.usage = usage
+    return msg, node, PEER
+
+
+def test_lease_lifecycle(ddhcp):
+    ddhcp.check_indexes()
+    assert ddhcp.fill.free >= ddhcp.config["spares"]
+
+    # Grant, housekeeping claims more blocks as they fill up
+    leases = []
+    for i in range(40):
+        leases.append(run(ddhcp, ddhcp.get_new_lease(b"client%i" % i)))
+        advance(ddhcp, 0.5)
+
+    assert len(set(lease.addr for lease in leases)) == 40
+    assert ddhcp.lease_count() == 40
+    assert run(ddhcp, ddhcp.get_new_lease(b"client0")) is leases[0]
+
+    advance(ddhcp, 10)
+
+    # Renewal
+    renewed = run(ddhcp, ddhcp.get_lease(leases[0].addr, b"client0"))
+    ddhcp.check_indexes()
+
+    assert renewed is leases[0]
+    assert renewed.valid_until == ddhcp.clock() + 2 * renewed.leasetime
+    assert ddhcp.expiry.deadlines[renewed] == renewed.valid_until
+
+    with pytest.raises(KeyError):
+        run(ddhcp, ddhcp.get_lease(leases[0].addr, b"someone else"))
+
+    # Release
+    ddhcp.release(leases[1].addr, b"client1")
+    ddhcp.check_indexes()
+
+    assert b"client1" not in ddhcp.clients
+    assert ddhcp.lease_count() == 39
+
+    # Expiry, the renewed lease outlives the others
+    advance(ddhcp, leases[-1].valid_until - ddhcp.clock() + 1)
+
+    assert renewed.valid_until > ddhcp.clock()
+    assert ddhcp.lease_count() == 1
+    assert list(ddhcp.clients) == [b"client0"]
+
+    advance(ddhcp, renewed.valid_until - ddhcp.clock() + 1)
+
+    assert ddhcp.lease_count() == 0
+    assert not ddhcp.clients
+    assert ddhcp.fill.free >= ddhcp.config["spares"]
+
+
+def test_peer_claims(ddhcp):
+    block = ddhcp.free_blocks()[0]
+
+    ddhcp.handle_UpdateClaim(*claim(block, 30))
+    ddhcp.check_indexes()
+
+    assert block.state == BlockState.CLAIMED and block.addr == PEER
+    assert ddhcp.peer_blocks[PEER] == {block}
+    assert ddhcp.expiry.deadlines[block] == ddhcp.clock() + 30
+
+    # A refresh only moves the deadline
+    advance(ddhcp, 10)
+    ddhcp.handle_UpdateClaim(*claim(block, 30))
+    ddhcp.check_indexes()
+
+    assert block.state == BlockState.CLAIMED
+    assert ddhcp.expiry.deadlines[block] == ddhcp.clock() + 30
+
+    # Timeout 0 frees the block
+    ddhcp.handle_UpdateClaim(*claim(block, 0))
+    ddhcp.check_indexes()
+
+    assert block.state == BlockState.FREE
+    assert PEER not in ddhcp.peer_blocks
+    assert ddhcp.protocol.gone == [PEER]
+
+    # A claim that is not refreshed expires
+    ddhcp.handle_UpdateClaim(*claim(block, 30))
+    advance(ddhcp, 31)
+
+    assert block.state == BlockState.FREE
+    assert block not in ddhcp.expiry
+
+    # Claims for blocks outside the pool are ignored
+    ddhcp.handle_UpdateClaim(*claim(len(ddhcp.blocks), 30))
+    ddhcp.check_indexes()
+
+
+@pytest.mark.parametrize("usage, won", [(0, True), (16, False)])
+def test_claim_dispute(ddhcp, usage, won):
+    lease = run(ddhcp, ddhcp.get_new_lease(b"client"))
+    block = ddhcp.block_from_ip(lease.addr)
+
+    ddhcp.handle_UpdateClaim(*claim(block, 30, usage))
+    ddhcp.check_indexes()
+
+    if won:
+        assert block.state == BlockState.OURS
+        assert block.leases[lease.addr] is lease
+    else:
+        # The winner learns of our leases before the block is reset
+        assert block.state == BlockState.CLAIMED and block.addr == PEER
+        assert (lease, PEER) in ddhcp.protocol.sent
+        assert b"client" not in ddhcp.clients
+
+    advance(ddhcp, 1)
+
+
+def test_peer_lease_cache_reset(ddhcp):
+    block = ddhcp.free_blocks()[0]
+    ddhcp.handle_UpdateClaim(*claim(block, 30))
+
+    lease = Lease()
+    lease.addr = block.network + 3
+    lease.client_id = b"client"
+    lease.leasetime = 60
+    ddhcp.peer_leases.put(lease, PEER, ddhcp.clock())
+
+    assert run(ddhcp, ddhcp.get_lease(lease.addr, b"client")) is lease
+
+    # A reset block may be claimed by someone else, its cached leases go
+    ddhcp.handle_UpdateClaim(*claim(block, 0))
+    ddhcp.check_indexes()
+
+    assert ddhcp.peer_leases.get(lease.addr, b"client", PEER, ddhcp.clock()) is None
+    assert len(ddhcp.peer_leases) == 0
+
+
+def test_restore(ddhcp):
+    now = ddhcp.clock()
+    ours = ddhcp.our_blocks()
+    free = ddhcp.free_blocks()[0:3]
+
+    state = JournalState()
+    state.blocks = set(block.index for block in free + ours[0:1])
+    state.leases = {
+        free[0].network + 1: (60, now + 100, b"a"),
+        free[0].network + 2: (60, now - 1, b"expired"),
+        free[1].network + 15: (60, now + 50, b"b"),
+        free[2].network + 4: (60, now - 1, b"expired too"),
+        # Blocks we already own or did not journal are left alone
+        ours[0].network + 5: (60, now + 50, b"c"),
+        ddhcp.free_blocks()[5].network: (60, now + 50, b"d"),
+    }
+
+    ddhcp.restore(state)
+    ddhcp.check_indexes()
+
+    assert free[0].state == free[1].state == BlockState.OURS
+    assert free[2].state == BlockState.FREE
+    assert sorted(free[0].leases) == [free[0].network + 1]
+    assert free[1].free == (1 << 15) - 1
+    assert sorted(ddhcp.clients) == [b"a", b"b"]
+
+    advance(ddhcp, 60)
+
+    assert sorted(ddhcp.clients) == [b"a"]
+
+
+def test_block_table_states():
+    table = BlockTable(0, 8, 4)
+
+    table.transition(3, BlockState.OURS, None)
+    table.transition(5, BlockState.CLAIMED, PEER)
+    table.transition(0, BlockState.OURS, None)
+    table.transition(3, BlockState.FREE, None)
+
+    assert sorted(table.by_state[BlockState.OURS]) == [table[0]]
+    assert sorted(table.by_state[BlockState.CLAIMED]) == [table[5]]
+    assert sorted(b.index for b in table.by_state[BlockState.FREE]) == [1, 2, 3, 4, 6, 7]
+    assert table[5].addr == PEER and table[3].addr is None
+
+    for state, blocks in table.by_state.items():
+        assert len(blocks) == table.count(state)
+
+        for position, index in enumerate(blocks.items):
+            assert table.positions[index] == position
+
+    sample = table.by_state[BlockState.FREE].sample(4)
+    assert len(sample) == len(set(sample)) == 4
+    assert all(block.state == BlockState.FREE for block in sample)
+
+    with pytest.raises(IndexError):
+        table[8]
+
+
+def test_fill_index():
+    table = BlockTable(0, 4, 4)
+    fill = FillIndex(4)
+
+    for block in table:
+        fill.update(block)
+
+    assert fill.free == 16
+    assert len(fill.empty()) == 4
+
+    lease = Lease()
+    lease.addr = 1
+    table[0].load_lease(lease)
+    fill.update(table[0])
+
+    assert fill.free == 15
+    assert fill.fullest() == table[0]
+    assert table[0] not in fill.empty()
+
+    fill.discard(table[0])
+    fill.discard(table[0])
+
+    assert fill.free == 12 and len(fill) == 3
+    assert table[0] not in fill
+
+
+def test_expiry_heap():
+    heap = ExpiryHeap()
+
+    for key in range(100):
+        heap.push(key, 100 - key)
+
+    # Stale entries from new deadlines and discards are skipped
+    for key in range(100):
+        heap.push(key, 1000 + key)
+
+    heap.discard(99)
+
+    assert len(heap) == 99
+    assert heap.next_deadline() == 1000
+    assert heap.pop_due(1010) == list(range(11))
+    assert 10 not in heap and 11 in heap
+    assert heap.pop_due(10000) == list(range(11, 99))
+    assert heap.next_deadline() is None
+
+
+def test_peer_lease_cache():
+    cache = PeerLeaseCache(2, 0.25)
+
+    leases = []
+    for addr in range(3):
+        lease = Lease()
+        lease.addr = addr
+        lease.client_id = b"%i" % addr
+        lease.leasetime = 100
+        leases.append(lease)
+
+    cache.put(leases[0], PEER, 0)
+    cache.put(leases[1], PEER, 0)
+    assert cache.get(0, b"0", PEER, 10) is leases[0]
+
+    # The least recently used entry goes first
+    cache.put(leases[2], PEER, 0)
+    assert cache.get(1, b"1", PEER, 10) is None
+    assert cache.get(0, b"0", PEER, 10) is leases[0]
+
+    # Served for a quarter of the leasetime, to the same client and owner
+    assert cache.get(2, b"other", PEER, 10) is None
+    cache.put(leases[2], PEER, 0)
+    assert cache.get(2, b"2", ("fe80::3", 1234), 10) is None
+    assert cache.get(0, b"0", PEER, 25) is None
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize("claimmode", ["full", "delta"])
+def test_simulator(monkeypatch, claimmode):
+    monkeypatch.setattr(simulator, "make_config", lambda *args, **kwargs: make_config(*args, selfcheck=True, **kwargs))
+    logging.disable(logging.WARNING)
+
+    args = argparse.Namespace(nodes=8, duration=120, startup=5, latency=0.005, jitter=0.005, loss=0.05,
+                              partition=30, heal=60, clients=2, sample=1, prefix="10.0.0.0/22",
+                              blocksize=16, spares=8, claimmode=claimmode, sparemode="adaptive", seed=1, json=None)
+
+    try:
+        cluster = simulator.Cluster(args)
+        results = cluster.run()
+    finally:
+        logging.disable(logging.NOTSET)
+        asyncio.set_event_loop(None)
+
+    for addr, ddhcp in cluster.nodes:
+        ddhcp.check_indexes()
+
+    assert results["duplicates_at_end"] == 0
+    assert "heal" in results["convergence_seconds"]
+    assert results["leases"]["granted"] > 0
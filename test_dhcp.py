@@ -0,0 +1,176 @@
+import struct
+from ipaddress import IPv4Address
+
+import pytest
+
+import dhcp
+import dhcpoptions
+from dhcpprotocol import ReplyOptions
+from lease import Lease
+
+TYPES = dhcpoptions.DHCPMessageType.TYPES
+
+
+def prl(*codes):
+    option = dhcpoptions.ParameterRequestList()
+    option.list = codes
+    return option
+
+
+def requested_ip(addr):
+    option = dhcpoptions.RequestedIPAddress()
+    option.addr = IPv4Address(addr)
+    return option
+
+
+def client_id(data):
+    option = dhcpoptions.ClientIdentifier()
+    option.data = data
+    return option
+
+
+@pytest.mark.parametrize("option, encoded", [
+    (dhcpoptions.SubnetMask(20), "0104fffff000"),
+    (dhcpoptions.SubnetMask(32), "0104ffffffff"),
+    (dhcpoptions.RouterOption([IPv4Address("10.0.0.1")]), "03040a000001"),
+    (dhcpoptions.RouterOption([IPv4Address("10.0.0.1"), IPv4Address("10.0.0.2")]), "03080a0000010a000002"),
+    (dhcpoptions.RouterOption([]), "0300"),
+    (dhcpoptions.DomainNameServerOption([IPv4Address("10.130.0.255"), IPv4Address("10.130.0.254")]), "06080a8200ff0a8200fe"),
+    (requested_ip("10.0.0.23"), "32040a000017"),
+    (dhcpoptions.IPAddressLeaseTime(3600), "330400000e10"),
+    (dhcpoptions.DHCPMessageType(TYPES.DHCPOFFER), "350102"),
+    (dhcpoptions.DHCPMessageType(TYPES.DHCPACK), "350105"),
+    (dhcpoptions.ServerIdentifier(IPv4Address("10.0.0.1")), "36040a000001"),
+    (prl(1, 3, 6), "3703010306"),
+    (client_id(b"\x01\x02\x00\x00\x00\x01"), "3d06010200000001"),
+    (dhcpoptions.EncodedOption(bytes.fromhex("350102")), "350102"),
+])
+def test_option_pack_into(option, encoded):
+    expected = bytes.fromhex(encoded)
+
+    assert len(option) == len(expected)
+    assert option.serialize() == expected
+
+    # Packing at an offset leaves the surrounding bytes alone
+    buf = bytearray(b"\xaa" * (len(expected) + 7))
+    assert option.pack_into(buf, 3) == 3 + len(expected)
+    assert buf == b"\xaa" * 3 + expected + b"\xaa" * 4
+
+
+def reply(msgtype, requested):
+    config = dict(siaddr=IPv4Address("10.0.0.1"), prefixlen=20)
+    replies = ReplyOptions(config)
+
+    lease = Lease()
+    lease.addr = int(IPv4Address("10.0.0.23"))
+    lease.leasetime = 3600
+    lease.routers = [int(IPv4Address("10.0.0.1"))]
+    lease.dns = [int(IPv4Address("10.130.0.255")), int(IPv4Address("10.130.0.254"))]
+
+    msg = dhcp.DHCPPacket()
+    msg.op = msg.BOOTREPLY
+    msg.htype = 1
+    msg.xid = 0x12345678
+    msg.flags = 0x8000
+    msg.giaddr = IPv4Address("10.0.0.254")
+    msg.chaddr = bytes([2, 0, 0, 0, 0, 1])
+    msg.yiaddr = lease.addr
+    msg.options.append(replies.header(msgtype))
+    msg.options.append(replies.lease(lease, requested))
+
+    return msg
+
+
+def encoded(msgtype, options):
+    """Reply encoded by hand, field by field."""
+    header = struct.pack("!BBBBLHHLLLL", 2, 1, 6, 0, 0x12345678, 0, 0x8000,
+                         0, int(IPv4Address("10.0.0.23")), 0, int(IPv4Address("10.0.0.254")))
+    chaddr = bytes([2, 0, 0, 0, 0, 1]) + bytes(10)
+
+    return (header + chaddr + bytes(64 + 128) + bytes([99, 130, 83, 99]) +
+            bytes.fromhex("36040a000001" + "3501%02x" % msgtype.value + options) + b"\xff")
+
+
+@pytest.mark.parametrize("msgtype", [TYPES.DHCPOFFER, TYPES.DHCPACK])
+@pytest.mark.parametrize("requested, options", [
+    (None, "330400000e10" "0104fffff000" "03040a000001" "06080a8200ff0a8200fe"),
+    ((1, 3, 6), "330400000e10" "0104fffff000" "03040a000001" "06080a8200ff0a8200fe"),
+    ((3,), "330400000e10" "03040a000001"),
+    ((), "330400000e10"),
+])
+def test_reply_serialize_into(msgtype, requested, options):
+    msg = reply(msgtype, requested)
+    expected = encoded(msgtype, options)
+
+    assert msg.serialize() == expected
+
+    # A reused buffer holding a longer packet only has its prefix replaced
+    buf = bytearray(b"\xaa" * 1024)
+    length = msg.serialize_into(buf)
+
+    assert length == len(expected)
+    assert buf[0:length] == expected
+    assert buf[length:] == b"\xaa" * (1024 - length)
+
+    # A buffer that is too small grows
+    buf = bytearray(16)
+    assert msg.serialize_into(buf) == len(expected)
+    assert buf == expected
+
+
+def test_reply_options_shared():
+    replies = ReplyOptions(dict(siaddr=IPv4Address("10.0.0.1"), prefixlen=20))
+
+    lease = Lease()
+    lease.leasetime = 3600
+    lease.routers = [int(IPv4Address("10.0.0.1"))]
+    lease.dns = []
+
+    # Lists that only differ in codes we never send share an entry
+    option = replies.lease(lease, (1, 3, 6, 15, 119))
+    assert replies.lease(lease, (3, 6, 1)) is option
+    assert replies.lease(lease, (1, 3, 6, 42)) is option
+    assert replies.lease(lease, None) is option
+    assert replies.lease(lease, (3, 28)) is not option
+    assert len(replies.cache) == 2
+
+
+@pytest.mark.parametrize("msgtype", [TYPES.DHCPOFFER, TYPES.DHCPACK])
+def test_reply_round_trip(msgtype):
+    msg = reply(msgtype, None)
+
+    parsed = dhcp.DHCPPacket()
+    parsed.deserialize(msg.serialize())
+
+    assert (parsed.op, parsed.htype, parsed.xid, parsed.flags) == (msg.BOOTREPLY, 1, 0x12345678, 0x8000)
+    assert parsed.chaddr == bytes([2, 0, 0, 0, 0, 1])
+    assert parsed.yiaddr == IPv4Address("10.0.0.23")
+    assert parsed.giaddr == IPv4Address("10.0.0.254")
+    assert parsed.ciaddr == parsed.siaddr == IPv4Address("0.0.0.0")
+
+    assert parsed.option(dhcpoptions.DHCPMessageType).type == msgtype
+    assert parsed.option(dhcpoptions.ServerIdentifier).addr == IPv4Address("10.0.0.1")
+    assert parsed.option(dhcpoptions.IPAddressLeaseTime).time == 3600
+    assert parsed.option(dhcpoptions.SubnetMask).prefixlen == 20
+    assert parsed.option(dhcpoptions.RouterOption).addrs == [IPv4Address("10.0.0.1")]
+    assert parsed.option(dhcpoptions.DomainNameServerOption).addrs == [IPv4Address("10.130.0.255"), IPv4Address("10.130.0.254")]
+    assert parsed.option(dhcpoptions.ClientIdentifier) is None
+
+
+def test_request_round_trip():
+    msg = dhcp.DHCPPacket()
+    msg.op = msg.BOOTREQUEST
+    msg.htype = 1
+    msg.xid = 7
+    msg.chaddr = bytes([2, 0, 0, 0, 0, 2])
+    msg.options = [dhcpoptions.DHCPMessageType(TYPES.DHCPREQUEST), requested_ip("10.0.0.42"),
+                   prl(1, 3, 6, 15), client_id(b"\x01abc")]
+
+    parsed = dhcp.parse_request(msg.serialize())
+
+    assert parsed.xid == 7
+    assert parsed.chaddr == bytes([2, 0, 0, 0, 0, 2])
+    assert parsed.option(dhcpoptions.DHCPMessageType).type == TYPES.DHCPREQUEST
+    assert parsed.option(dhcpoptions.RequestedIPAddress).addr == IPv4Address("10.0.0.42")
+    assert tuple(parsed.option(dhcpoptions.ParameterRequestList).list) == (1, 3, 6, 15)
+    assert parsed.option(dhcpoptions.ClientIdentifier).data == b"\x01abc"